@@ -0,0 +1,648 @@
+'''
+Benchmark
+
+Time the parse.py stages against the code paths they replace,
+the legacy ones being those of reference.py.
+
+Usage:
+    python benchmark.py excel <file.xlsx>
+    python benchmark.py xlsx <file.txt>
+    python benchmark.py cleaner [file.txt]
+    python benchmark.py classifier <file.txt>
+    python benchmark.py records <file.txt>
+    python benchmark.py addresses <file.txt>
+    python benchmark.py formats <file.txt>
+    python benchmark.py startup <file.txt> [runs]
+    python benchmark.py stages <results.json> <rows[,rows...]> [baseline.json [threshold]]
+
+stages times each pipeline stage on synthetic files of each
+size and saves the results as JSON. Given a baseline, a stage
+more than threshold (default 0.2, 20%) slower fails the run.
+'''
+
+import sys
+import os
+import time
+import gc
+import random
+import timeit
+import itertools
+import json
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+from distutils.spawn import find_executable
+
+import openpyxl
+
+import parse
+import reference
+import synthetic
+
+# Numbers in a number format and the text Excel saves for
+# them in a CSV
+EXCEL_FORMAT_CASES = [(2134, "00000", "02134"),
+                      (21340001, "00000-0000", "02134-0001"),
+                      (2134, "[<=99999]00000;00000-0000", "02134"),
+                      (213400012, "[<=99999]00000;00000-0000", "21340-0012"),
+                      (62500.125, "General", "62500.125"),
+                      (1234.5, "#,##0.00", "1,234.50"),
+                      (-1234.5, "#,##0.00;(#,##0.00)", "(1,234.50)"),
+                      (0.256, "0.0%", "25.6%"),
+                      (1500, '#,##0,"K"', "2K"),
+                      (3, "0.00", "3.00")]
+
+
+def timeCall(func, *args, **kwargs):
+    """ Run func once with the garbage collector paused, as 
+    timeit does. Return the elapsed seconds and result. """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.time()
+        result = func(*args, **kwargs)
+        return time.time() - start, result
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def benchExcelReader(excel_file):
+    """ Compare the native openpyxl reader with the Excel/cscript
+    round trip. The round trip only runs where cscript exists. """
+
+    data_fields = parse.create_data_fields()
+    static_hdr = [f[0] for f in data_fields]
+    us_dict = parse.create_us_dict()
+
+    native_secs, native_rows = timeCall(
+        lambda: list(parse.iterXLSX(excel_file, us_dict, data_fields, static_hdr)))
+    report = [("native openpyxl", native_secs, len(native_rows))]
+
+    differences = checkExcelFormats()
+    for value, number_format, expected, text in differences:
+        print "WARNING: {!r} in {!r} read as {!r}, Excel writes {!r}".format(
+            value, number_format, text, expected)
+    print "Number formats: {} of {} read as Excel writes them\n".format(
+        len(EXCEL_FORMAT_CASES) - len(differences), len(EXCEL_FORMAT_CASES))
+
+    if find_executable("cscript"):
+        # Work on a copy so the temp CSV lands outside the input folder.
+        temp_dir = tempfile.mkdtemp()
+        try:
+            excel_copy = os.path.join(temp_dir, os.path.basename(excel_file))
+            shutil.copy(excel_file, excel_copy)
+
+            def roundTrip():
+                csv_file = parse.convertXLStoCSV(temp_dir, excel_copy)
+                return parse.processXLSfromCSV(csv_file, us_dict, data_fields, static_hdr)
+
+            csv_secs, csv_rows = timeCall(roundTrip)
+            report.append(("cscript + CSV", csv_secs, len(csv_rows)))
+
+            if csv_rows != native_rows:
+                print "WARNING: native reader output differs from the CSV round trip"
+        finally:
+            shutil.rmtree(temp_dir)
+    else:
+        print "cscript not found, skipping the Excel round trip\n"
+
+    printReport(report)
+
+
+def checkExcelFormats():
+    """ Save EXCEL_FORMAT_CASES in a workbook and read them back
+    the way iterXLSX does. Return the cases that differ, with
+    the text read. """
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        excel_file = os.path.join(temp_dir, "formats.xlsx")
+        wb = openpyxl.Workbook()
+        for row, (value, number_format, expected) in enumerate(EXCEL_FORMAT_CASES, start=1):
+            wb.active.cell(row, 1, value).number_format = number_format
+        wb.save(excel_file)
+
+        wb = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+        texts = [parse.formatExcelRow(row)[0] for row in wb.active.iter_rows()]
+        wb.close()
+    finally:
+        shutil.rmtree(temp_dir)
+    return [case + (text,) for case, text in zip(EXCEL_FORMAT_CASES, texts)
+            if case[2] != text]
+
+
+def legacyWriteRecordsToXLS(outputDir, filename_noext, records_dict, static_hdr):
+    """ The in-memory writer used before write only mode. """
+    wb = openpyxl.Workbook()
+    ws = wb.create_sheet("Records", 0)
+    ws.append(static_hdr)
+
+    for seq, row in enumerate(parse.iterAllRecords(records_dict), start=1):
+        row[static_hdr.index("Sequence")] = seq
+        ws.append(row)
+
+    wb.save(os.path.join(outputDir, "{}_rev.xlsx".format(filename_noext)))
+
+
+def runXLSWriter(args):
+    """ Load the TXT file and time one xlsx writer. Run in a 
+    child process so each writer gets its own peak RSS. """
+    writer_name, txt_file, outputDir = args
+    writer = {"legacy": legacyWriteRecordsToXLS,
+              "write only": parse.writeRecordsToXLS}[writer_name]
+
+    static_hdr = [f[0] for f in parse.create_data_fields()]
+    records_dict = parse.createRecordsDict(parse.iterTXT(txt_file, static_hdr),
+                                           static_hdr, "A", spool=True)
+    secs, _ = timeCall(writer, outputDir, writer_name.replace(" ", "_"),
+                       records_dict, static_hdr)
+    count = sum(len(records) for records in records_dict.values())
+    return secs, count, parse.peakRSS() or float("nan")
+
+
+def benchXLSWriter(txt_file):
+    """ Compare the legacy in-memory workbook with the 
+    write only writer on the records of a TXT file. """
+
+    temp_dir = tempfile.mkdtemp()
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        print "{:<20}{:>12}{:>12}{:>14}".format("Writer", "Seconds", "Records", "Peak RSS MB")
+        for writer_name in ["legacy", "write only"]:
+            secs, count, peak_rss = pool.apply(
+                runXLSWriter, [(writer_name, txt_file, temp_dir)])
+            print "{:<20}{:>12.3f}{:>12}{:>14.1f}".format(writer_name, secs, count, peak_rss)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(temp_dir)
+
+
+def oddBytesCorpus(seed=20180128, samples=20000):
+    """ Byte strings that exercise the cleaner: every single 
+    byte and byte pair, valid UTF-8 from each range, truncated 
+    and overlong sequences and random noise inside ASCII text. """
+
+    corpus = [chr(i) for i in xrange(256)]
+    corpus.extend(chr(i) + chr(j) for i in xrange(256) for j in xrange(256))
+
+    for code in [0x7f, 0x80, 0xa0, 0xa6, 0xe9, 0xff, 0x100, 0x20ac, 0xfffd, 0x1f600]:
+        char = (u"\\U%08x" % code).decode("unicode-escape")
+        encoded = char.encode("utf-8")
+        corpus.append(encoded)
+        corpus.append("ABC " + encoded + " DEF")
+        corpus.extend(encoded[:cut] for cut in xrange(1, len(encoded)))
+
+    corpus.extend(["\xc0\x80", "\xe0\x80\x80", "\xed\xa0\x80", "\xf4\x90\x80\x80",
+                   "\xc2\xa0\xc2\xa6", "caf\xe9 ", "\xef\xbf\xbd", ""])
+
+    rand = random.Random(seed)
+    noise = ["\x80", "\xa0", "\xa6", "\xc2\xa0", "\xc2\xa6", "\xc3\xa9", "\xe2\x82",
+             "\xe2\x82\xac", "\xff", "\xfe", "\xef\xbf\xbd", "\r\n", "\t"]
+    for _ in xrange(samples):
+        parts = []
+        for _ in xrange(rand.randint(1, 8)):
+            if rand.random() < 0.5:
+                parts.append("".join(chr(rand.randint(32, 126))
+                                     for _ in xrange(rand.randint(0, 12))))
+            else:
+                parts.append(rand.choice(noise))
+        corpus.append("".join(parts))
+    return corpus
+
+
+def cleanerResult(cleaner, text):
+    """ Cleaner output, or the exception type it raised. """
+    try:
+        return cleaner(text)
+    except Exception as e:
+        return type(e)
+
+
+def checkCleanerEquivalence():
+    """ Compare replaceNonAsciiChars with the legacy cleaner 
+    over the odd bytes corpus. Return the mismatches. """
+    mismatches = []
+    for text in oddBytesCorpus():
+        expected = cleanerResult(reference.replaceNonAsciiChars, text)
+        actual = cleanerResult(parse.replaceNonAsciiChars, text)
+        if expected != actual or type(expected) != type(actual):
+            mismatches.append((text, expected, actual))
+    return mismatches
+
+
+def benchCleaner(txt_file=None):
+    """ Check that the cleaners agree, then time them on pure 
+    ASCII lines, lines with non-ASCII bytes and, if given, 
+    the lines of a TXT file. """
+
+    corpus = oddBytesCorpus()
+    mismatches = checkCleanerEquivalence()
+    print "Equivalence: {} of {} inputs differ".format(len(mismatches), len(corpus))
+    for text, expected, actual in mismatches[:10]:
+        print "  {!r}: legacy {!r} fast {!r}".format(text, expected, actual)
+    print ""
+
+    ascii_line = "JOHN Q DOE".ljust(516) + "\r\n"
+    samples = [("ASCII line", [ascii_line]),
+               ("non-ASCII line", [ascii_line[:200] + "\xc2\xa0caf\xc3\xa9" + ascii_line[206:]])]
+    if txt_file:
+        with open(txt_file, 'rb') as o:
+            samples.append((os.path.basename(txt_file), o.readlines()))
+
+    print "{:<20}{:>14}{:>14}{:>10}".format("Input", "Legacy us", "Fast us", "Speedup")
+    for name, lines in samples:
+        number = max(1, 200000 // len(lines))
+        timings = []
+        for cleaner in [reference.replaceNonAsciiChars, parse.replaceNonAsciiChars]:
+            secs = timeit.timeit(lambda: [cleaner(line) for line in lines], number=number)
+            timings.append(secs / (number * len(lines)) * 1e6)
+        print "{:<20}{:>14.3f}{:>14.3f}{:>9.1f}x".format(
+            name, timings[0], timings[1], timings[0] / timings[1])
+
+    return 1 if mismatches else 0
+
+
+def foreignKeys(txt_file):
+    """ (city, last address line) of each foreign record. """
+    static_hdr = [f[0] for f in parse.create_data_fields()]
+    city_idx = static_hdr.index("Mailing City")
+    state_idx = static_hdr.index("Mailing State")
+    addr_start = static_hdr.index("NameAddress1")
+    addr_end = static_hdr.index("NameAddress8") + 1
+    keys = []
+    for record in parse.iterTXT(txt_file, static_hdr):
+        if record[state_idx] == "FO":
+            addrfields = [f for f in record[addr_start:addr_end] if f.upper() not in ["", "NULL"]]
+            keys.append((record[city_idx], addrfields[-1]))
+    return keys
+
+
+def placeNameKeys():
+    """ Each place name alone, in other case, embedded in 
+    text, cut short and run into the next word. """
+    keys = []
+    for place in parse.CANADA_PLACES + parse.MEXICO_PLACES:
+        for city in [place, place.upper(), place.lower(), "1 {} 2".format(place),
+                     place[:-1], place + "X", "X" + place, place + " UK", place + " SPAIN"]:
+            keys.append((city, "MAIN ST"))
+    keys.extend([("TORONTO ON M5V 2T6", ""), ("QC H2X 1Y4", ""), ("PARIS", "CANADA"),
+                 ("LONDON ON", ""), ("Baja California Surf", ""), ("St. John's", "")])
+    return keys
+
+
+def benchClassifier(txt_file):
+    """ Check CountryClassifier against the legacy regexes and 
+    compare records/sec on the foreign records of a TXT file. """
+
+    keys = foreignKeys(txt_file)
+
+    mismatches = [(city, last) for city, last in keys + placeNameKeys()
+                  if reference.classify(city, last) != 
+                  parse.CountryClassifier().decide(city, last)]
+    print "Equivalence: {} of {} inputs differ".format(len(mismatches), len(keys + placeNameKeys()))
+    for city, last in mismatches[:10]:
+        print "  {!r} {!r}".format(city, last)
+    print ""
+
+    legacy_secs, _ = timeCall(lambda: [reference.classify(city, last) for city, last in keys])
+    classifier = parse.CountryClassifier()
+    classifier_secs, _ = timeCall(lambda: [classifier.classify(city, last) for city, last in keys])
+    uncached = parse.CountryClassifier(cache_size=0)
+    uncached_secs, _ = timeCall(lambda: [uncached.decide(city, last) for city, last in keys])
+
+    printReport([("legacy regexes", legacy_secs, len(keys)),
+                 ("classifier no memo", uncached_secs, len(keys)),
+                 ("classifier", classifier_secs, len(keys))])
+    print "\nMemo hits: {} of {}".format(classifier.cache_hits, classifier.count)
+    return 1 if mismatches else 0
+
+
+def microsPerItem(func, items):
+    """ Mean microseconds of func over items. Results are 
+    dropped so memory growth does not skew the timing. """
+    def run():
+        for item in items:
+            func(item)
+    secs, _ = timeCall(run)
+    return secs / len(items) * 1e6
+
+
+def benchRecords(txt_file):
+    """ Per-record CPU of parsing and address building with 
+    static_hdr.index() and list surgery against RecordLayout 
+    and the "0s" struct fields, and the bytes of each record 
+    list. Both paths must produce the same records. """
+
+    static_hdr = [f[0] for f in parse.create_data_fields()]
+    layout = parse.RecordLayout(static_hdr)
+    with open(txt_file, 'rb') as o:
+        lines = o.readlines()
+
+    legacy_parse = microsPerItem(lambda line: reference.parseTXTLine(line, static_hdr), lines)
+    layout_parse = microsPerItem(parse.parseTXTLine, lines)
+
+    records = [parse.parseTXTLine(line) for line in lines]
+    same_records = all(reference.parseTXTLine(line, static_hdr) == record 
+                       for line, record in itertools.izip(lines, records))
+    legacy_bytes = sys.getsizeof(reference.parseTXTLine(lines[0], static_hdr))
+    record_bytes = sys.getsizeof(records[0])
+    del lines
+
+    for record in records:
+        record[layout.type_idx] = "FGN" if record[layout.state_idx] == "FO" else "DOM"
+    legacy_mm = microsPerItem(lambda record: reference.createMMAddress(record, static_hdr), records)
+    layout_mm = microsPerItem(lambda record: parse.createMMAddress(record, static_hdr, layout), records)
+    same_addresses = all(reference.createMMAddress(record, static_hdr) == 
+                         parse.createMMAddress(record, static_hdr, layout) for record in records)
+
+    print "{} records. Same records: {}  Same addresses: {}\n".format(
+        len(records), same_records, same_addresses)
+    print "{:<24}{:>14}{:>14}".format("Per record", "Legacy", "Layout")
+    print "{:<24}{:>14.2f}{:>14.2f}".format("parse us", legacy_parse, layout_parse)
+    print "{:<24}{:>14.2f}{:>14.2f}".format("createMMAddress us", legacy_mm, layout_mm)
+    print "{:<24}{:>14}{:>14}".format("record list bytes", legacy_bytes, record_bytes)
+    return 0 if same_records and same_addresses else 1
+
+
+# A stage this much slower than the baseline is a regression
+REGRESSION_THRESHOLD = 0.2
+
+# Stages faster than this in both runs are too noisy to compare
+MIN_COMPARE_SECONDS = 0.05
+
+
+def timeStages(temp_dir, rows):
+    """ Write synthetic TXT and XLSX files of rows records and 
+    time each stage of the pipeline on them. createRecordsDict 
+    is timed without the parsing that feeds it. """
+
+    static_hdr = [f[0] for f in parse.create_data_fields()]
+    data_fields = parse.create_data_fields()
+    us_dict = parse.create_us_dict()
+    txt_file = os.path.join(temp_dir, "synthetic.txt")
+    synthetic.writeTXT(txt_file, rows)
+
+    def clean():
+        with open(txt_file, 'rb') as o:
+            for line in o:
+                parse.replaceNonAsciiChars(line)
+
+    def parseTXT():
+        for record in parse.iterTXT(txt_file, static_hdr):
+            pass
+
+    stages = {}
+    stages["replaceNonAsciiChars"], _ = timeCall(clean)
+    stages["parse TXT"], _ = timeCall(parseTXT)
+
+    classifier_secs = parse.COUNTRY_CLASSIFIER.seconds
+    secs, records_dict = timeCall(parse.createRecordsDict, parse.iterTXT(txt_file, static_hdr),
+                                  static_hdr, "A", spool=True)
+    stages["createRecordsDict"] = secs - stages["parse TXT"]
+    stages["sortForeignByCountry"] = parse.COUNTRY_CLASSIFIER.seconds - classifier_secs
+    try:
+        stages["writeRecordsToCSV"], _ = timeCall(parse.writeRecordsToCSV, temp_dir, 
+                                                  records_dict, static_hdr)
+        stages["writeRecordsToXLS"], _ = timeCall(parse.writeRecordsToXLS, temp_dir, 
+                                                  "synthetic", records_dict, static_hdr)
+    finally:
+        for records in records_dict.values():
+            records.close()
+
+    if rows <= parse.XLS_MAX_ROWS:
+        excel_file = os.path.join(temp_dir, "synthetic.xlsx")
+        synthetic.writeXLSX(excel_file, rows)
+        stages["parse XLSX"], _ = timeCall(
+            lambda: list(parse.iterXLSX(excel_file, us_dict, data_fields, static_hdr)))
+
+    return dict((stage, {"seconds": secs, "records": rows, 
+                         "records_per_sec": rows / secs if secs > 0 else 0})
+                for stage, secs in stages.items())
+
+
+def benchStages(results_file, sizes, baseline_file=None, threshold=REGRESSION_THRESHOLD):
+    """ Run timeStages for each size and save the results. 
+    With a baseline, return 1 when a stage regressed. """
+
+    results = {"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "python": sys.version.split()[0], "platform": sys.platform, "sizes": {}}
+    for rows in sizes:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            stages = timeStages(temp_dir, rows)
+        finally:
+            shutil.rmtree(temp_dir)
+        results["sizes"][str(rows)] = {"stages": stages, "peak_rss_mb": parse.peakRSS()}
+        print "{} records".format(rows)
+        printReport([(stage, stages[stage]["seconds"], rows) for stage in sorted(stages)])
+        print ""
+
+    with open(results_file, 'wb') as o:
+        json.dump(results, o, indent=2, sort_keys=True)
+    print "Results saved to {}\n".format(results_file)
+
+    if not baseline_file:
+        return 0
+    with open(baseline_file, 'rb') as o:
+        baseline = json.load(o)
+    regressions = compareStages(baseline, results, threshold)
+    print "\n{} regressions beyond {:.0%}".format(len(regressions), threshold)
+    return 1 if regressions else 0
+
+
+def compareStages(baseline, results, threshold):
+    """ Print each stage against the baseline and return the 
+    (size, stage) pairs more than threshold slower. """
+
+    regressions = []
+    print "{:>10}  {:<22}{:>12}{:>12}{:>10}".format("Records", "Stage", "Baseline", "Seconds", "Change")
+    for size in sorted(results["sizes"], key=int):
+        base_stages = baseline["sizes"].get(size, {}).get("stages", {})
+        for stage, timing in sorted(results["sizes"][size]["stages"].items()):
+            if stage not in base_stages:
+                continue
+            base_secs = base_stages[stage]["seconds"]
+            secs = timing["seconds"]
+            change = secs / base_secs - 1 if base_secs > 0 else 0.0
+            flag = ""
+            if change > threshold and max(secs, base_secs) >= MIN_COMPARE_SECONDS:
+                regressions.append((size, stage))
+                flag = "  REGRESSION"
+            print "{:>10}  {:<22}{:>12.3f}{:>12.3f}{:>+10.0%}{}".format(
+                size, stage, base_secs, secs, change, flag)
+    return regressions
+
+
+def benchAddresses(txt_file):
+    """ Compare the AddressData.csv rows of the legacy per record 
+    builder, createMMAddress and AddressBuilder chunks on the 
+    sorted records of a TXT file. All three must agree. """
+
+    static_hdr = [f[0] for f in parse.create_data_fields()]
+    layout = parse.RecordLayout(static_hdr)
+    records_dict = parse.createRecordsDict(parse.iterTXT(txt_file, static_hdr), static_hdr, "A")
+    records = list(parse.iterSequenced(records_dict, static_hdr))
+    del records_dict
+
+    def addressRow(line, address):
+        return ["", "", "", line[layout.seq_idx]] + address + [line[layout.lt_idx], line[layout.seq_idx]]
+
+    def legacy():
+        return [addressRow(line, reference.createMMAddress(line, static_hdr)) for line in records]
+
+    def perRecord():
+        return [addressRow(line, parse.createMMAddress(line, static_hdr, layout)) for line in records]
+
+    def chunked():
+        builder = parse.AddressBuilder(static_hdr)
+        rows = []
+        for chunk in parse.iterChunks(records, parse.ADDRESS_CHUNK_SIZE):
+            rows.extend(builder.addressRows(chunk))
+        return rows
+
+    report = []
+    results = []
+    for name, build in [("legacy", legacy), ("createMMAddress", perRecord), 
+                        ("AddressBuilder", chunked)]:
+        secs, rows = timeCall(build)
+        report.append((name, secs, len(rows)))
+        results.append(rows)
+
+    same = results[0] == results[1] == results[2]
+    print "Same rows: {}\n".format(same)
+    printReport(report)
+    return 0 if same else 1
+
+
+def benchFormats(txt_file):
+    """ Write the Static Data of a TXT file in each of the 
+    STATIC_FORMATS and read it back, all fields and just LT and 
+    Sequence. Every format must read back the CSV records. """
+
+    static_hdr = [f[0] for f in parse.create_data_fields()]
+    records_dict = parse.createRecordsDict(parse.iterTXT(txt_file, static_hdr), static_hdr, "A")
+    records = list(parse.iterSequenced(records_dict, static_hdr))
+    del records_dict
+
+    def read(path, fields=None):
+        return sum(1 for row in parse.iterStaticData(path, fields))
+
+    def readBack(path):
+        return [[str(value) for value in row] for row in parse.iterStaticData(path)]
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print "{:<10}{:>10}{:>10}{:>8}{:>10}{:>12}".format(
+            "Format", "Write s", "MB", "Ratio", "Read s", "Read 2 s")
+        same = True
+        expected = csv_size = None
+        for static_format, name in parse.STATIC_FORMATS.items():
+            if static_format == "zstd":
+                try:
+                    import zstandard
+                except ImportError:
+                    print "{:<10}needs the zstandard package".format(static_format)
+                    continue
+            path = os.path.join(temp_dir, name)
+            write_secs = timeCall(parse.writeStaticData, temp_dir, "", records, 
+                                  static_hdr, static_format)[0]
+            size = os.path.getsize(path)
+            read_secs = timeCall(read, path)[0]
+            read_two_secs = timeCall(read, path, ["LT", "Sequence"])[0]
+            rows = readBack(path)
+            if expected is None:
+                expected, csv_size = rows, size
+            same = same and rows == expected
+            print "{:<10}{:>10.3f}{:>10.1f}{:>8.2f}{:>10.3f}{:>12.3f}".format(
+                static_format, write_secs, size / 1048576.0, float(csv_size) / size, 
+                read_secs, read_two_secs)
+            del rows
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print "\nSame records: {}".format(same)
+    return 0 if same else 1
+
+
+# Run in a fresh interpreter by benchStartup. Prints the seconds 
+# to import parse and to reach the first record of the TXT file.
+STARTUP_SCRIPT = """
+import time
+start = time.time()
+import parse
+imported = time.time()
+static_hdr = [f[0] for f in parse.create_data_fields()]
+parse.create_us_dict()
+next(parse.iterTXT({!r}, static_hdr))
+parse.COUNTRY_CLASSIFIER.classify("TORONTO ON", "CANADA")
+print imported - start, time.time() - start
+"""
+
+
+def benchStartup(txt_file, runs=10):
+    """ Time importing parse and reaching the first parsed and 
+    classified record of a TXT file, each in a fresh interpreter. 
+    The best of runs is reported. """
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(parse.__file__))] + 
+        [path for path in [env.get("PYTHONPATH")] if path])
+    script = STARTUP_SCRIPT.format(txt_file)
+
+    def run():
+        start = time.time()
+        output = subprocess.check_output([sys.executable, "-c", script], env=env)
+        process_secs = time.time() - start
+        import_secs, first_secs = [float(secs) for secs in output.split()]
+        return import_secs, first_secs, process_secs
+
+    timings = [run() for _ in xrange(runs)]
+    print "{:>12}{:>18}{:>14}".format("Import ms", "First record ms", "Process ms")
+    print "{:>12.1f}{:>18.1f}{:>14.1f}".format(
+        *[1000 * min(column) for column in zip(*timings)])
+    return 0
+
+
+def printReport(report):
+    print "{:<22}{:>12}{:>12}{:>14}".format("Path", "Seconds", "Records", "Records/sec")
+    for name, secs, count in report:
+        rate = count / secs if secs else 0
+        print "{:<22}{:>12.3f}{:>12}{:>14.0f}".format(name, secs, count, rate)
+
+
+def main(argv=None):
+    argv = argv or sys.argv[1:]
+    if len(argv) == 2 and argv[0] == "excel":
+        benchExcelReader(os.path.abspath(argv[1]))
+    elif len(argv) == 2 and argv[0] == "xlsx":
+        benchXLSWriter(os.path.abspath(argv[1]))
+    elif argv and argv[0] == "cleaner" and len(argv) <= 2:
+        txt_file = os.path.abspath(argv[1]) if len(argv) == 2 else None
+        return benchCleaner(txt_file)
+    elif len(argv) == 2 and argv[0] == "classifier":
+        return benchClassifier(os.path.abspath(argv[1]))
+    elif len(argv) == 2 and argv[0] == "records":
+        return benchRecords(os.path.abspath(argv[1]))
+    elif len(argv) == 2 and argv[0] == "addresses":
+        return benchAddresses(os.path.abspath(argv[1]))
+    elif len(argv) == 2 and argv[0] == "formats":
+        return benchFormats(os.path.abspath(argv[1]))
+    elif argv and argv[0] == "startup" and len(argv) in [2, 3]:
+        runs = int(argv[2]) if len(argv) == 3 else 10
+        return benchStartup(os.path.abspath(argv[1]), runs)
+    elif argv and argv[0] == "stages" and len(argv) in [3, 4, 5]:
+        sizes = [int(rows) for rows in argv[2].split(",")]
+        baseline_file = argv[3] if len(argv) >= 4 else None
+        threshold = float(argv[4]) if len(argv) == 5 else REGRESSION_THRESHOLD
+        return benchStages(argv[1], sizes, baseline_file, threshold)
+    else:
+        print __doc__
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
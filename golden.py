@@ -0,0 +1,330 @@
+'''
+Golden
+
+Differential test of the parse.py code paths. The golden outputs
+come from reference.py, the original record handling that shares
+no code with parse.py. Each engine then processes the same input,
+and its AddressData.csv, Static Data, COUNTS.txt and _rev.xlsx
+are diffed against the golden ones record by record. The rows of
+the _rev.xlsx are those of the golden StaticData.dat.
+
+The input is a seeded synthetic.py edge file unless a TXT file
+in the reference layout is given. Engines are the parse.py option
+sets in ENGINES, all of them by default, each run once with the
+serial writers and once with --concurrent-writers. An engine can
+also be module:function, a function taking (txt_file, outputDir,
+letterCode) that writes the outputs into outputDir, its _rev.xlsx
+being checked only if written. An engine whose options parse.py
+rejects here, such as --static-format zstd without zstandard, is
+skipped. parse.py runs with PARSE_CONSTANTS lowered, so the small
+inputs still take several TXT chunks and foreign sort runs.
+Sharded address output is diffed as the shards joined in manifest
+order, after checking each against its manifest entry. Without
+openpyxl the _rev.xlsx is not written or checked.
+
+Usage:
+    python golden.py [rows [seed [engine ...]]]
+    python golden.py file <file.txt> [engine ...]
+'''
+
+import sys
+import os
+import csv
+import json
+import hashlib
+import cStringIO
+import shutil
+import tempfile
+import itertools
+import importlib
+import subprocess
+import collections
+
+import parse
+import reference
+import synthetic
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# The _rev.xlsx takes most of the time of each engine
+DEFAULT_ROWS = 5000
+
+LETTER_CODE = "A"
+
+PARSE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# parse.py constants lowered for the engines, so at golden's row
+# counts --workers merges many chunks and the foreign sort spills
+# and merges several runs. They do not change the outputs.
+PARSE_CONSTANTS = collections.OrderedDict([
+    ("TXT_CHUNK_SIZE", 64 * 1024),
+    ("SORT_RUN_SIZE", 100),
+])
+
+# Runs parse.py's main with PARSE_CONSTANTS set, the arguments
+# following it as for parse.py
+ENGINE_SCRIPT = """
+import sys
+sys.path.insert(0, {!r})
+import parse
+{}
+sys.exit(parse.main(sys.argv[1:]))
+""".format(PARSE_DIR, "\n".join("parse.{} = {!r}".format(name, value)
+                                  for name, value in PARSE_CONSTANTS.items()))
+
+# parse.py options of each engine. {tmp} is the run's temporary
+# folder, so delta-warm reuses the store delta filled.
+ENGINES = collections.OrderedDict([
+    ("pipeline", []),
+    ("workers", ["--workers", "3"]),
+    ("delta", ["--delta", "{tmp}/delta.db"]),
+    ("delta-warm", ["--delta", "{tmp}/delta.db"]),
+    ("mailed-index", ["--mailed-index", "{tmp}/mailed.db"]),
+    ("stage", ["--stage"]),
+    ("shards", ["--shards", "7"]),
+    ("shards-type", ["--shards", "type"]),
+    ("gzip", ["--static-format", "gzip"]),
+    ("zstd", ["--static-format", "zstd"]),
+    ("columns", ["--static-format", "columns"]),
+    ("xlsx-sheets", ["--xlsx-rows", "700"]),
+    ("xlsx-files", ["--xlsx-rows", "700", "--xlsx-split-files"]),
+])
+
+# Each engine runs with both ways of writing the outputs
+WRITER_MODES = [("", []), ("+concurrent", ["--concurrent-writers"])]
+
+OUTPUTS = ["AddressData.csv", "StaticData", "COUNTS.txt", "_rev.xlsx"]
+
+# The golden output an output is diffed against
+GOLDEN_OUTPUTS = {"_rev.xlsx": "StaticData"}
+
+# Differences printed per engine, all of them are counted
+DIFF_LIMIT = 10
+
+
+def runReference(txt_file, outputDir, letterCode=LETTER_CODE):
+    """ Write the golden outputs with reference.py. """
+
+    static_hdr = reference.STATIC_HDR
+    records = reference.processTXT(txt_file, static_hdr)
+    records_dict = reference.createRecordsDict(records, static_hdr, letterCode)
+    reference.writeRecordsToCSV(outputDir, records_dict, static_hdr)
+    reference.writeCountsToTXT(outputDir, os.path.basename(txt_file), records_dict)
+    return sum(len(category_records) for category_records in records_dict.values())
+
+
+def runEngine(engine, txt_file, outputDir, temp_dir, writer_options=()):
+    """ Run an engine into outputDir. Returns None, or the reason
+    the engine was skipped. Raises RuntimeError if it failed. """
+
+    if ":" in engine:
+        module, function = engine.split(":")
+        getattr(importlib.import_module(module), function)(txt_file, outputDir, LETTER_CODE)
+        return None
+
+    options = [option.format(tmp=temp_dir) for option in ENGINES[engine]]
+    command = [sys.executable, "-c", ENGINE_SCRIPT, txt_file, "--letter-code", LETTER_CODE,
+               "--output-dir", outputDir] + options + list(writer_options)
+    if not openpyxl:
+        command.append("--no-xlsx")
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode == 2 and "error: " in output:
+        # argparse rejected the options
+        return output.strip().splitlines()[-1].split("error: ", 1)[1]
+    if process.returncode:
+        raise RuntimeError("{} exited with {}:\n{}".format(
+            engine, process.returncode, "\n".join(output.splitlines()[-10:])))
+    return None
+
+
+def findOutput(outputDir, name):
+    """ The path of an output in outputDir, whatever its prefix
+    and Static Data format, or None. """
+    for filename in sorted(os.listdir(outputDir)):
+        if filename.endswith(name) or (name == "StaticData" and
+                                       name in filename and not filename.endswith(".json")):
+            return os.path.join(outputDir, filename)
+    return None
+
+
+def readOutput(path):
+    """ The rows of an output as lists of strings, the header first. """
+    if path.endswith("COUNTS.txt"):
+        with open(path, 'rb') as c:
+            return [["COUNTS.txt"]] + [[line] for line in c.read().split("\r\n")]
+    if path.endswith(".csv"):
+        with open(path, 'rb') as a:
+            return list(csv.reader(a))
+    if path.endswith(".xlsx"):
+        rows = []
+        for workbook in iterWorkbookFiles(path):
+            for ws in openpyxl.load_workbook(workbook, read_only=True).worksheets:
+                sheet_rows = [["" if value is None else str(value) for value in row]
+                              for row in ws.iter_rows(values_only=True)]
+                # Each sheet starts with the header
+                rows.extend(sheet_rows[1:] if rows else sheet_rows)
+        return rows
+    return [[str(value) for value in row] for row in parse.iterStaticData(path)]
+
+
+def iterWorkbookFiles(path):
+    """ A _rev.xlsx and the _rev_2.xlsx, _rev_3.xlsx... that
+    --xlsx-split-files continues it in. """
+    yield path
+    file_no = 2
+    while os.path.exists("{}_{}.xlsx".format(path[:-len(".xlsx")], file_no)):
+        yield "{}_{}.xlsx".format(path[:-len(".xlsx")], file_no)
+        file_no += 1
+
+
+def readShards(manifest_path):
+    """ The rows of the shards in a --shards manifest joined
+    into one AddressData.csv, and messages for the shards whose
+    checksum, row count or Sequence range is not as listed. """
+
+    with open(manifest_path, 'rb') as m:
+        manifest = json.load(m)
+    rows = []
+    messages = []
+    for shard in manifest["shards"]:
+        with open(os.path.join(os.path.dirname(manifest_path), shard["name"]), 'rb') as a:
+            data = a.read()
+        if hashlib.sha256(data).hexdigest() != shard["sha256"]:
+            messages.append("{} does not match its SHA-256".format(shard["name"]))
+        shard_rows = list(csv.reader(cStringIO.StringIO(data)))
+        rows = rows or shard_rows[:1]
+        sequences = [int(row[3]) for row in shard_rows[1:]]
+        expected = []
+        if shard["rows"]:
+            expected = range(shard["first_sequence"], shard["last_sequence"] + 1)
+        if len(sequences) != shard["rows"] or sequences != expected:
+            messages.append("{} does not hold Sequence {} to {}".format(
+                shard["name"], shard["first_sequence"], shard["last_sequence"]))
+        rows.extend(shard_rows[1:])
+    return rows, messages
+
+
+def diffRows(name, golden, rows):
+    """ The number of differing rows and messages for the first
+    DIFF_LIMIT of them. Lines are numbered from the header, 1. """
+
+    header = golden[0]
+    count = 0
+    messages = []
+    for line_no, (expected, actual) in enumerate(itertools.izip_longest(golden, rows), start=1):
+        if expected == actual:
+            continue
+        count += 1
+        if len(messages) >= DIFF_LIMIT:
+            continue
+        if expected is None:
+            message = "extra row {!r}".format(actual)
+        elif actual is None:
+            message = "missing row {!r}".format(expected)
+        else:
+            fields = header if len(header) >= max(len(expected), len(actual)) else []
+            message = "; ".join("{} {!r} != {!r}".format(field, e, a) for field, e, a in
+                itertools.izip_longest(fields, expected, actual, fillvalue="") if e != a)
+        messages.append("{} line {}: {}".format(name, line_no, message))
+    return count, messages
+
+
+def diffOutputs(goldenDir, outputDir, outputs):
+    """ The differing rows of each output and messages for them. """
+    count = 0
+    messages = []
+    for name in outputs:
+        path = findOutput(outputDir, name)
+        if path is None and name == "AddressData.csv":
+            path = findOutput(outputDir, parse.SHARD_MANIFEST)
+        if path is None:
+            count += 1
+            messages.append("{} was not written".format(name))
+            continue
+        golden = readOutput(findOutput(goldenDir, GOLDEN_OUTPUTS.get(name, name)))
+        if path.endswith(parse.SHARD_MANIFEST):
+            rows, shard_messages = readShards(path)
+            count += len(shard_messages)
+            messages.extend(shard_messages)
+        else:
+            rows = readOutput(path)
+        output_count, output_messages = diffRows(os.path.basename(path), golden, rows)
+        count += output_count
+        messages.extend(output_messages)
+    return count, messages
+
+
+def runGolden(txt_file, engines):
+    """ Diff each engine against the golden outputs and print a
+    line per engine. Returns the number of engines that failed. """
+
+    temp_dir = tempfile.mkdtemp(prefix="golden-")
+    try:
+        goldenDir = os.path.join(temp_dir, "golden")
+        os.makedirs(goldenDir)
+        total = runReference(txt_file, goldenDir)
+        print "{}: {} records{}".format(txt_file, total,
+                                         "" if openpyxl else ", _rev.xlsx not checked")
+
+        runs = []
+        for engine in engines:
+            if ":" in engine:
+                runs.append((engine, engine, ()))
+            else:
+                runs.extend((engine + suffix, engine, options)
+                            for suffix, options in WRITER_MODES)
+
+        failed = 0
+        for name, engine, writer_options in runs:
+            outputDir = os.path.join(temp_dir, name.replace(":", "-"))
+            os.makedirs(outputDir)
+            try:
+                skipped = runEngine(engine, txt_file, outputDir, temp_dir, writer_options)
+            except Exception as e:
+                failed += 1
+                print "{:<24} FAILED  {}".format(name, e)
+                continue
+            if skipped:
+                print "{:<24} skipped {}".format(name, skipped)
+                continue
+            outputs = [output for output in OUTPUTS if output != "_rev.xlsx" or openpyxl and
+                       (":" not in engine or findOutput(outputDir, output))]
+            count, messages = diffOutputs(goldenDir, outputDir, outputs)
+            if count:
+                failed += 1
+            print "{:<24} {}".format(name, "{} differences".format(count) if count else "OK")
+            for message in messages:
+                print "    " + message
+        return failed
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    engines = argv[2:] or ENGINES.keys()
+    if (argv[:1] in [["-h"], ["--help"]] or argv[:1] == ["file"] and len(argv) < 2 or
+            [engine for engine in engines if engine not in ENGINES and ":" not in engine]):
+        print __doc__
+        return 1
+
+    if argv[:1] == ["file"]:
+        return 1 if runGolden(argv[1], engines) else 0
+
+    rows = int(argv[0]) if argv else DEFAULT_ROWS
+    seed = int(argv[1]) if len(argv) > 1 else synthetic.DEFAULT_SEED
+    temp_dir = tempfile.mkdtemp(prefix="golden-input-")
+    try:
+        txt_file = os.path.join(temp_dir, "EDGE_{}.txt".format(seed))
+        synthetic.writeTXT(txt_file, rows, seed, edge_cases=True)
+        return 1 if runGolden(txt_file, engines) else 0
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -58,58 +58,821 @@ import csv
 import subprocess
 import re
 import struct
-import openpyxl
+import operator
+import heapq
+import bisect
+import tempfile
+import itertools
+import datetime
+import decimal
+import time
+import argparse
+import multiprocessing
+import collections
+import glob
+import traceback
+import contextlib
+import signal
+import mmap
+import hashlib
+import marshal
+import sqlite3
+import json
+import cProfile
+import cPickle
+import cStringIO
+import gzip
+import zlib
+import io
+import Queue
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Letter codes of the GMC templates
+LETTER_CODES = ["A", "AC", "FA", "FC", "R", "RC"]
+
+# Seconds between inbox scans in --watch mode
+WATCH_POLL_SECONDS = 0.2
+
+# --delta chunks end after a line whose CRC ends in this many zero 
+# bits, about 4096 lines on average, or at DELTA_CHUNK_MAX lines. 
+# A store of another version is emptied when opened.
+DELTA_CHUNK_BITS = 12
+DELTA_CHUNK_MAX = 16384
+DELTA_STORE_VERSION = 3
+
+# Records claimed in the --mailed-index per transaction
+MAILED_BATCH_SIZE = 10000
+
+# Seconds a --mailed-index run may go without updating the 
+# index before it is taken to have crashed and its keys are 
+# released, and seconds between its updates while the outputs 
+# are written
+MAILED_RUN_TIMEOUT = 3600
+MAILED_TOUCH_SECONDS = 60
+
+# Joins the address fields a record from the --delta store 
+# carries. Fields never hold a tab, their whitespace is collapsed.
+ADDRESS_SEPARATOR = "\t"
+
+# The --stage file, named like the other outputs, and the 
+# outputs --from-stage can write again
+STAGE_FILE = "STAGE.db"
+STAGE_EXPORTS = ["csv", "xlsx", "counts"]
+
+# Mailing categories in the order they are sequenced
+MAILING_ORDER = ["MEX", "CAN", "FGN", "DOM"]
+
+# --shards files, numbered or named by category, and the 
+# manifest listing them
+SHARD_FILE = "AddressData_{}.csv"
+SHARD_MANIFEST = "AddressData_MANIFEST.json"
+
+# TXT lines that could not be parsed, as they were in the input, 
+# and the exit code of a run that wrote any
+MALFORMED_FILE = "MALFORMED.txt"
+EXIT_MALFORMED = 3
+
+# Number of foreign records sorted in memory before a sorted
+# run is spilled to disk during the external sort by city.
+SORT_RUN_SIZE = 100000
+
+# Provinces and major cities that mark a Canadian address
+CANADA_PLACES = ["Canada","Alberta","Calgary","Edmonton",
+    "Strathcona County","British Columbia","Vancouver","Surrey","Burnaby","Manitoba",
+    "Winnipeg","Brandon","Springfield","New Brunswick","Moncton","Saint John","Fredericton",
+    "Newfoundland and Labrador","St. John's","Conception Bay South","Mount Pearl",
+    "Northwest Territories","Yellowknife","Hay River","Inuvik","Nova Scotia",
+    "Halifax","Sydney","Lunenburg","Nunavut","Iqaluit","Arviat","Rankin Inlet",
+    "Ontario","Toronto","Ottawa","Mississauga","Prince Edward Island","Charlottetown",
+    "Summerside","Stratford","Quebec","Montreal","Quebec City","Laval","Saskatchewan",
+    "Saskatoon","Regina","Prince Albert","Yukon","Whitehorse","Dawson City","Faro"]
+
+# States and major cities that mark a Mexican address
+MEXICO_PLACES = ["Chihuahua","Sonora","Coahuila",
+    "Durango","Oaxaca","Tamaulipas","Jalisco","Zacatecas","Baja California Sur",
+    "Chiapas","Veracruz","Baja California","Nuevo Leon","Guerrero","San Luis Potosi",
+    "Michoacan","Sinaloa","Campeche","Quintana Roo","Yucatan","Puebla","Guanajuato",
+    "Nayarit","Tabasco","Mexico","Hidalgo","Queretaro","Colima","Aguascalientes",
+    "Morelos","Tlaxcala","Ciudad de Mexico","Mexico City","Ecatepec","Guadalajara",
+    "Puebla","Juarez","Tijuana","Leon","Monterrey","Zapopan","Nezahualcoyotl","Culiacan",
+    "Chihuahua","Naucalpan","Merida","San Luis Potosi","Aguascalientes","Hermosillo",
+    "Saltillo","Mexicali","Guadalupe","Acapulco","Tlalnepantla","Cancun","Queretaro",
+    "Chimalhuacan","Torreon","Morelia","Reynosa","Tlaquepaque","Tuxtla Gutierrez",
+    "Durango","Toluca","Ciudad Lopez Mateos","Cuautitlan Izcalli","Ciudad Apodaca","Matamoros",
+    "San Nicolas de los Garza","Veracruz","Xalapa","Tonala","Mazatlan","Irapuato",
+    "Nuevo Laredo","Xico","Villahermosa","General Escobedo","Celaya","Cuernavaca","Tepic",
+    "Ixtapaluca","Ciudad Victoria","Ciudad Obregon","Tampico","Ciudad Nicolas Romero",
+    "Ensenada","Coacalco de Berriozabal","Santa Catarina","Uruapan","Gomez Palacio",
+    "Los Mochis","Pachuca","Oaxaca","Soledad de Graciano Sanchez","Tehuacan","Ojo de Agua",
+    "Coatzacoalcos","Campeche","Monclova","La Paz","Nogales","Buenavista","Puerto Vallarta",
+    "Tapachula","Ciudad Madero","San Pablo de las Salinas","Chilpancingo","Poza Rica",
+    "Chicoloapan de Juarez","Ciudad del Carmen","Chalco de Diaz Covarrubias","Jiutepec",
+    "Salamanca","San Luis Rio Colorado","Cuautla","Ciudad Benito Juarez","Chetumal",
+    "Piedras Negras","Playa del Carmen","Zamora","Cordoba","San Juan del Rio","Colima",
+    "Ciudad Acuna","Manzanillo","Zacatecas","Veracruz","Ciudad Valles","Guadalupe",
+    "San Pedro Garza Garcia","Naucalpan","Fresnillo","Orizaba","Miramar","Iguala",
+    "Delicias","Ciudad de Villa de alvarez","Ciudad Cuauhtemoc","Navojoa","Guaymas",
+    "Minatitlan","Cuautitlan","Texcoco","Hidalgo del Parral","Tepexpan","Tulancingo"]
+
+# Distinct (city, last address line) decisions the country
+# classifier remembers before its memo is cleared.
+CLASSIFIER_CACHE_SIZE = 100000
+
+# Fixed width layouts of the TXT input by version, oldest first. 
+# Each version declares its fields in file order as (static_hdr 
+# name, width) or (static_hdr name, width, transform), where the 
+# transform is applied to the cleaned value. Fields a version does 
+# not declare come out blank. The file has seven address lines; 
+# the 7th lands in NameAddress8 and NameAddress7 stays blank.
+TXT_FIELDS_2015 = [("FileTransmissionDate", 8), ("UPRR Job Number", 6), ("LT", 9),
+                   ("Company Name", 40), ("Company Number", 12), ("ASTSourceFileDate", 8),
+                   ("Account Number", 19), ("NameAddress1", 40), ("NameAddress2", 40),
+                   ("NameAddress3", 40), ("NameAddress4", 40), ("NameAddress5", 40),
+                   ("NameAddress6", 40), ("NameAddress8", 40), ("Verification Code", 4),
+                   ("Filler", 36), ("Mailing City", 40), ("Zip", 9), ("Mailing State", 2),
+                   ("Shares", 14), ("Certified", 1), ("LetterCode", 2), ("Sequence", 6)]
+TXT_LAYOUT_VERSIONS = [
+    ("2015-10-20", TXT_FIELDS_2015),
+    ("2017-11-28", TXT_FIELDS_2015 + [("Escheatment State", 20)])
+    ]
+
+# Translate tables for replaceNonAsciiChars
+ASCII_BYTES = "".join(chr(i) for i in xrange(128))
+NON_ASCII_TO_SPACE = ASCII_BYTES + " " * 128
+
+# Lines sampled from the start of a TXT file to find its record length
+RECORD_LENGTH_SAMPLE = 100
+
+# Translate table that marks the bytes a record can not be 
+# unpacked past in place: non-ASCII bytes need cleaning and a 
+# newline means a short line.
+SLOW_PATH_MARKS = "".join("\x01" if i > 127 or chr(i) == "\n" else "\x00" 
+                          for i in xrange(256))
+
+# Bytes of the mapped TXT input checked for slow path bytes at once
+TXT_SCAN_SIZE = 1024 * 1024
+
+# Records per chunk sent to the output writer processes, and 
+# chunks each writer may have queued before the sequencing 
+# pass waits for it.
+WRITER_CHUNK_SIZE = 1000
+WRITER_QUEUE_CHUNKS = 16
+
+# Records read from the input between parse timings
+METRICS_CHUNK_SIZE = 1000
+
+# Bytes of TXT input handed to each worker with --workers, and 
+# chunks in flight per worker, parsed or being parsed, before 
+# the reader waits for the oldest
+TXT_CHUNK_SIZE = 8 * 1024 * 1024
+TXT_CHUNKS_PER_WORKER = 2
+
+# Header of AddressData.csv, the Mail Manager import
+ADDRESS_HDR = ["IM barcode Digits", "OEL", "Sack and Pack Numbers",
+    "Presort Sequence", "Full Name", "Name2", "Name3", 
+    "Name4","Name5","Name6","Name7","Name8","Delivery Address",
+    "Alternate 1 Address","City","State","ZIP+4","LTNo","SEQ"]
+
+# Delivery lines that are an apartment, suite, floor etc. The 
+# street line before them becomes the Delivery Address.
+APT_PATTERN = re.compile(r'^((#|B(UI)?LD(IN)?G|SUITE|LOT|UNIT|FLOOR|R(OO)?M|AP(ARTMEN)?T).+|(\d{1,4}\s?\w)|(\d{1,3}(ST|ND|RD|TH)?\s?FL(OO)?R?))$', flags=re.IGNORECASE)
+
+# Name/Address lines left out of the Mail Manager address: 
+# blanks and NULL in any case.
+BLANK_ADDRESS_LINES = frozenset([""] + ["".join(letters) for letters in 
+                                        itertools.product("Nn", "Uu", "Ll", "Ll")])
+
+# Records per chunk in the AddressBuilder, and distinct last 
+# address lines it remembers before its memo is cleared.
+ADDRESS_CHUNK_SIZE = 1000
+ADDRESS_CACHE_SIZE = 100000
+
+# Records per worksheet in the _rev.xlsx output. Excel allows 
+# 1,048,576 rows and the header takes one of them. The write 
+# only workbook streams its rows to disk only where lxml is 
+# installed; without it each sheet is built in memory.
+XLS_MAX_ROWS = 1048575
+
+# A section condition of an Excel number format, like the 
+# [<=99999] of the ZIP+4 format, and the number formats 
+# compiled by compileExcelFormat
+EXCEL_CONDITION = re.compile(r"^(<=|>=|<>|<|>|=)(-?[0-9.]+)$")
+EXCEL_CONDITION_OPS = {"<=": operator.le, ">=": operator.ge, "<>": operator.ne, 
+                       "<": operator.lt, ">": operator.gt, "=": operator.eq}
+EXCEL_FORMATS = {}
+
+# Formats of the Static Data output and their file names. The 
+# compressed CSVs hold the same bytes as StaticData.dat. The 
+# column file keeps the records in row groups of typed columns, 
+# see StaticColumnWriter.
+STATIC_FORMATS = collections.OrderedDict([("csv", "StaticData.dat"), 
+                                          ("gzip", "StaticData.dat.gz"), 
+                                          ("zstd", "StaticData.dat.zst"), 
+                                          ("columns", "StaticData.cols")])
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+COLUMN_LEVEL = 6
+COLUMN_GROUP_ROWS = 100000
+COLUMN_MAGIC = "DDCOLS1\n"
+
+
+# One input file and where its outputs go. Outputs are named 
+# prefix + AddressData.csv etc, and name + _rev.xlsx.
+Job = collections.namedtuple("Job", ["inFile", "outputDir", "name", "prefix", "letterCode"])
+
+# One AddressData file: rows records from Sequence first_sequence on, 
+# all of one AddressType when category is set
+Shard = collections.namedtuple("Shard", ["name", "category", "first_sequence", "rows"])
 
 
 def main(argv=None):
 
-    inFile = os.path.abspath(sys.argv[1])
-    outputDir = os.path.dirname(inFile)
+    args = parseArgs(argv)
+    if args.watch:
+        return watchInbox(args)
+    if args.from_stage:
+        return exportStage(args)
+    
+    inFiles = findInputFiles(args.inputs, args.manifest)
+    if not inFiles:
+        print "No input files found"
+        return 1
+    
+    letterCode = args.letter_code or chooseLetterCode()
+    jobs = planJobs(inFiles, args.output_dir, letterCode)
+    
+    if len(jobs) == 1:
+        return EXIT_MALFORMED if processFile(jobs[0], args) else 0
+    return runJobs(jobs, args)
+
+
+def processFile(job, args):
+    """ Run one input file through the pipeline. With --profile 
+    the run is profiled into PROFILE.pstats next to COUNTS.txt. 
+    Return the number of malformed TXT lines. """
+    
+    if not args.profile:
+        return runPipeline(job, args)
+    
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(runPipeline, job, args)
+    finally:
+        profile_file = os.path.join(job.outputDir, job.prefix + "PROFILE.pstats")
+        profiler.dump_stats(profile_file)
+        print "Profile saved to {}\n".format(profile_file)
+
+
+def runPipeline(job, args):
+    
+    start, cpu_start = time.time(), cpuTime()
+    metrics = RunMetrics()
+    
+    inFile = job.inFile
+    outputDir = job.outputDir
     filename = os.path.basename(inFile)
-    filename_noext = ".".join(filename.split(".")[:-1])
     file_extension = filename.split(".")[-1]
     
-    letterCode = chooseLetterCode()
-    
     data_fields = create_data_fields()
     static_hdr = [f[0] for f in data_fields]
     us_dict = create_us_dict()
+    delta = DeltaStore(args.delta, static_hdr) if args.delta else None
+    mailed = (MailedIndex(args.mailed_index, static_hdr, inFile, outputDir, job.prefix) 
+              if args.mailed_index else None)
+    malformed = []
     
-    recordsList = []
-
-    if file_extension.upper() in ["XLS", "XLSX"]:
+    if file_extension.upper() == "XLSX":
+        print "Formatting data from Excel....\n"
+        records = iterXLSX(inFile, us_dict, data_fields, static_hdr, delta)
+    elif file_extension.upper() == "XLS":
+        # Legacy binary workbooks still need Excel to save a CSV.
         print "Formatting data from Excel....\n"
         csv_file = convertXLStoCSV(outputDir, inFile)
-        recordsList = processXLSfromCSV(csv_file, us_dict, data_fields, static_hdr)
+        records = iterXLSfromCSV(csv_file, us_dict, data_fields, static_hdr, delta)
     else:
         print "Formatting data from Text....\n"
-        recordsList = processTXT(inFile, static_hdr)
+        records = iterTXT(inFile, static_hdr, workers=args.workers, delta=delta, 
+                          rejects=malformed)
 
+    # Records are streamed from the input into per category 
+    # spool files so memory stays flat for large inputs.
     print "Sorting records....\n"
-    records_dict = createRecordsDict(recordsList, static_hdr, letterCode)
+    classified, cache_hits, seconds, cpu_seconds = (COUNTRY_CLASSIFIER.count, 
+        COUNTRY_CLASSIFIER.cache_hits, COUNTRY_CLASSIFIER.seconds, 
+        COUNTRY_CLASSIFIER.cpu_seconds)
+    sort_start, sort_cpu_start = time.time(), cpuTime()
+    records = metrics.iterTimed("parse", records)
+    if mailed:
+        records = mailed.iterUnmailed(records)
+    try:
+        records_dict = createRecordsDict(records, static_hdr, job.letterCode, spool=True)
+    except:
+        if mailed:
+            mailed.close()
+        raise
+    finally:
+        if delta:
+            delta.close()
+    if delta:
+        print delta.report() + "\n"
+    if mailed:
+        print mailed.report() + "\n"
+    if malformed:
+        writeMalformed(outputDir, job.prefix, malformed)
+    classified = COUNTRY_CLASSIFIER.count - classified
+    seconds = COUNTRY_CLASSIFIER.seconds - seconds
+    cpu_seconds = COUNTRY_CLASSIFIER.cpu_seconds - cpu_seconds
+    print "Classified {} foreign records at {:.0f} records/sec ({} from cache)\n".format(
+        classified, classified / seconds if seconds else 0.0, 
+        COUNTRY_CLASSIFIER.cache_hits - cache_hits)
     
-    print "Writing records to CSV....\n"
-    writeRecordsToCSV(outputDir, records_dict, static_hdr)                     
+    # Parsing, the mailed index lookups and classifying run 
+    # inside createRecordsDict, "sort" is the rest of it. A 
+    # DeltaStore classifies the new records while parsing.
+    parsed = metrics.stages["parse"]
+    inner_seconds = (parsed["wall_seconds"] + seconds + (mailed.seconds if mailed else 0.0) - 
+                     (delta.seconds if delta else 0.0))
+    inner_cpu_seconds = (parsed["cpu_seconds"] + cpu_seconds + 
+                         (mailed.cpu_seconds if mailed else 0.0) - 
+                         (delta.cpu_seconds if delta else 0.0))
+    metrics.add("sort", time.time() - sort_start - inner_seconds, 
+                cpuTime() - sort_cpu_start - inner_cpu_seconds, parsed["records"])
+    metrics.add("classify", seconds, cpu_seconds, classified)
     
-    print "Writing records to Excel....\n"
-    writeRecordsToXLS(outputDir, filename_noext, records_dict, static_hdr)                       
+    stage = None
+    try:
+        total = sum(len(category_records) for category_records in records_dict.values())
+        if args.stage:
+            # The outputs are written from the stage, as --from-stage writes them
+            print "Staging records....\n"
+            stage = StageStore(os.path.join(outputDir, job.prefix + STAGE_FILE), 
+                               static_hdr, job, len(malformed))
+            metrics.measure("stage", total, stage.load, records_dict)
+            for category_records in records_dict.values():
+                category_records.close()
+            records_dict = stage.recordsDict()
+        
+        # A --mailed-index run keeps its keys while the outputs are written
+        progress = None
+        if mailed:
+            mailed.touch()
+            progress = mailed.touch
+        
+        if not concurrentWriters(args):
+            print "Writing records to CSV....\n"
+            metrics.measure("write CSV", total, writeRecordsToCSV, outputDir, records_dict, 
+                            static_hdr, job.prefix, args.static_format, args.shards, progress)
+            
+            if not args.no_xlsx:
+                print "Writing records to Excel....\n"
+                metrics.measure("write XLSX", total, writeRecordsToXLS, 
+                                outputDir, job.name, records_dict, static_hdr, 
+                                args.xlsx_rows, args.xlsx_split_files, progress)                       
+        else:
+            print "Writing records to CSV{}....\n".format("" if args.no_xlsx else " and Excel")
+            metrics.measure("write", total, writeOutputs, outputDir, job.name, 
+                            records_dict, static_hdr, job.prefix, not args.no_xlsx, 
+                            args.static_format, args.shards, 
+                            args.xlsx_rows, args.xlsx_split_files, progress)
+        
+        writeCountsToTXT(outputDir, filename, records_dict, job.prefix, len(malformed))
+        if mailed:
+            mailed.markMailed()
+            metrics.add("index", mailed.seconds, mailed.cpu_seconds, mailed.checked)
+        metrics.add("total", time.time() - start, cpuTime() - cpu_start, total)
+        writeMetricsToJSON(outputDir, filename, metrics, job.prefix)
+        return len(malformed)
+    finally:
+        for category_records in records_dict.values():
+            category_records.close()
+        if stage:
+            stage.close()
+        if mailed:
+            mailed.close()
+
+
+def concurrentWriters(args):
+    """ Whether the outputs are written by writeOutputs. --jobs 
+    pool workers can not start writer processes, and on one CPU 
+    they only add overhead unless --concurrent-writers asks. """
+    if multiprocessing.current_process().daemon:
+        return False
+    return args.concurrent_writers or multiprocessing.cpu_count() > 1
+
+
+def exportStage(args):
+    """ Write the outputs again from a --stage file, without 
+    parsing. The letter code and the categories of the records 
+    can be changed on the way, and are kept in the stage. The 
+    outputs go beside the stage unless --output-dir is given. """
     
-    writeCountsToTXT(outputDir, filename, records_dict)            
+    start = time.time()
+    stage = StageStore(args.from_stage)
+    try:
+        if args.letter_code:
+            stage.setLetterCode(args.letter_code)
+        for lt, category in args.set_category:
+            stage.setCategory(lt, category)
+        if args.set_category:
+            stage.resequence()
+        
+        exports = args.export or [e for e in STAGE_EXPORTS if not (args.no_xlsx and e == "xlsx")]
+        outputDir = args.output_dir or os.path.dirname(os.path.abspath(args.from_stage))
+        if not os.path.isdir(outputDir):
+            os.makedirs(outputDir)
+        records_dict = stage.recordsDict()
+        static_hdr = stage.static_hdr
+        
+        if "csv" in exports and concurrentWriters(args):
+            print "Writing records to CSV{}....\n".format(" and Excel" if "xlsx" in exports else "")
+            writeOutputs(outputDir, stage.name, records_dict, static_hdr, stage.prefix, 
+                         "xlsx" in exports, args.static_format, args.shards, 
+                         args.xlsx_rows, args.xlsx_split_files)
+        else:
+            if "csv" in exports:
+                print "Writing records to CSV....\n"
+                writeRecordsToCSV(outputDir, records_dict, static_hdr, stage.prefix, 
+                                  args.static_format, args.shards)
+            if "xlsx" in exports:
+                print "Writing records to Excel....\n"
+                writeRecordsToXLS(outputDir, stage.name, records_dict, static_hdr, 
+                                  args.xlsx_rows, args.xlsx_split_files)
+        if "counts" in exports:
+            writeCountsToTXT(outputDir, stage.filename, records_dict, stage.prefix, 
+                             stage.malformed)
+    finally:
+        stage.close()
+    print "\nExported {} from {} in {:.1f} seconds".format(
+        ", ".join(exports), args.from_stage, time.time() - start)
+    return 0
+
+
+def findInputFiles(patterns, manifest=None):
+    """ Expand the input paths and globs, plus one path or glob 
+    per line of the manifest. Paths are returned once each, in 
+    the order given. A plain path is kept even if it does not 
+    exist so the job reports the missing file. """
+    
+    patterns = list(patterns)
+    if manifest:
+        with open(manifest, 'rb') as m:
+            patterns.extend(line.strip() for line in m 
+                            if line.strip() and not line.startswith("#"))
+    
+    inFiles = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                print "No files match {}".format(pattern)
+        else:
+            matches = [pattern]
+        for match in matches:
+            inFile = os.path.abspath(match)
+            if inFile not in inFiles:
+                inFiles.append(inFile)
+    return inFiles
+
+
+def planJobs(inFiles, outputDir, letterCode):
+    """ Create a Job per input file. A single input without an 
+    output directory keeps the fixed AddressData.csv, 
+    StaticData.dat and COUNTS.txt names beside the input. 
+    Otherwise the outputs are prefixed with the input name, 
+    adding _2, _3... when names would collide. """
+    
+    if outputDir:
+        outputDir = os.path.abspath(outputDir)
+        if not os.path.isdir(outputDir):
+            os.makedirs(outputDir)
+    
+    jobs = []
+    used_names = set()
+    for inFile in inFiles:
+        jobDir = outputDir or os.path.dirname(inFile)
+        filename_noext = ".".join(os.path.basename(inFile).split(".")[:-1])
+        if len(inFiles) == 1 and not outputDir:
+            jobs.append(Job(inFile, jobDir, filename_noext, "", letterCode))
+            continue
+        
+        name = filename_noext
+        copy_no = 1
+        while (jobDir, name.upper()) in used_names:
+            copy_no += 1
+            name = "{}_{}".format(filename_noext, copy_no)
+        used_names.add((jobDir, name.upper()))
+        jobs.append(Job(inFile, jobDir, name, name + "_", letterCode))
+    return jobs
+
+
+def runJobs(jobs, args):
+    """ Process the jobs in a pool of args.jobs processes. The 
+    largest files start first so the run takes about as long 
+    as the largest file. A failed job is reported and does not 
+    stop the others. """
+    
+    jobs = sorted(jobs, key=inputSize, reverse=True)
+    pool = multiprocessing.Pool(min(args.jobs, len(jobs)))
+    failed = []
+    try:
+        for inFile, error in pool.imap_unordered(runJob, [(job, args) for job in jobs]):
+            if error:
+                print "FAILED: {}\n{}".format(inFile, error)
+                failed.append(inFile)
+            else:
+                print "Done: {}\n".format(inFile)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    
+    print "{} of {} files processed".format(len(jobs) - len(failed), len(jobs))
+    for inFile in failed:
+        print "Failed: {}".format(inFile)
+    return 1 if failed else 0
+
+
+def runJob(job_args):
+    """ Pool worker for runJobs. Return the input file and 
+    the traceback if it failed. A file with malformed TXT 
+    lines fails once its outputs are written. """
+    job, args = job_args
+    try:
+        malformed = processFile(job, args)
+        if malformed:
+            return job.inFile, "{} malformed records written to {}".format(
+                malformed, os.path.join(job.outputDir, job.prefix + MALFORMED_FILE))
+        return job.inFile, None
+    except Exception:
+        return job.inFile, traceback.format_exc()
+
+
+def inputSize(job):
+    try:
+        return os.path.getsize(job.inFile)
+    except OSError:
+        return 0
+
+
+def watchInbox(args):
+    """ Service mode. Poll the inbox for new TXT/XLS/XLSX files 
+    and run each through processFile in a pool of args.jobs 
+    processes that stay up between files, so imports and 
+    compiled patterns are already warm. A file is claimed 
+    once its size and time stop changing by renaming it into 
+    processing/, then renamed into done/ or failed/. Outputs go 
+    to --output-dir, or output/ in the inbox. Stop with Ctrl+C 
+    or SIGTERM. """
+    
+    inbox = os.path.abspath(args.watch)
+    folders = dict((name, os.path.join(inbox, name)) 
+                   for name in ["processing", "done", "failed"])
+    outputDir = os.path.abspath(args.output_dir or os.path.join(inbox, "output"))
+    for folder in folders.values() + [outputDir]:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+    
+    # Files left in processing/ by a stopped service are retried
+    for filename in os.listdir(folders["processing"]):
+        moveAtomic(os.path.join(folders["processing"], filename), inbox)
+    
+    print "Watching {}\n".format(inbox)
+    pool = multiprocessing.Pool(args.jobs, ignoreInterrupt)
+    
+    # Stop the same way on Ctrl+C and on a service manager's SIGTERM
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, stopService)
+    seen = {}
+    pending = {}
+    used_names = set()
+    try:
+        while True:
+            finishJobs(pending, folders)
+            
+            # New files that have stopped growing
+            current = {}
+            for filename in os.listdir(inbox):
+                inFile = os.path.join(inbox, filename)
+                if (os.path.isfile(inFile) and 
+                    filename.split(".")[-1].upper() in ["TXT", "XLS", "XLSX"]):
+                    stat = os.stat(inFile)
+                    current[inFile] = (stat.st_size, stat.st_mtime)
+            
+            for inFile, signature in current.items():
+                if seen.get(inFile) != signature:
+                    continue
+                try:
+                    claimed = moveAtomic(inFile, folders["processing"])
+                except OSError:
+                    # Still locked by the writer, try again next poll
+                    continue
+                job = planServiceJob(claimed, outputDir, args.letter_code, used_names)
+                pending[claimed] = pool.apply_async(runJob, [(job, args)])
+                del current[inFile]
+            seen = current
+            
+            time.sleep(WATCH_POLL_SECONDS)
+    except KeyboardInterrupt:
+        print "Stopping, waiting for {} running files".format(len(pending))
+        pool.close()
+        pool.join()
+        finishJobs(pending, folders)
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    return 0
+
+
+def finishJobs(pending, folders):
+    """ Move the claimed files of finished jobs into done/ 
+    or failed/ and drop them from pending. """
+    for claimed, result in pending.items():
+        if result.ready():
+            del pending[claimed]
+            inFile, error = result.get()
+            moveAtomic(claimed, folders["failed"] if error else folders["done"])
+            print "{}: {}\n{}".format("FAILED" if error else "Done", 
+                                      os.path.basename(claimed), error or "")
+
+
+def stopService(signum, frame):
+    raise KeyboardInterrupt
+
+
+def ignoreInterrupt():
+    """ Pool initializer. Leave Ctrl+C and SIGTERM to the 
+    service loop, which lets running files finish. """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def planServiceJob(inFile, outputDir, letterCode, used_names):
+    """ A Job whose output names do not clash with outputs 
+    already in the output directory, nor with the names in 
+    used_names, those of the jobs the service has started. 
+    Its name is added to used_names. """
+    filename_noext = ".".join(os.path.basename(inFile).split(".")[:-1])
+    name = filename_noext
+    copy_no = 1
+    while (name.upper() in used_names or 
+           os.path.exists(os.path.join(outputDir, name + "_COUNTS.txt"))):
+        copy_no += 1
+        name = "{}_{}".format(filename_noext, copy_no)
+    used_names.add(name.upper())
+    return Job(inFile, outputDir, name, name + "_", letterCode)
+
+
+def moveAtomic(path, folder):
+    """ Rename path into folder, on the same drive so the move 
+    is atomic. A number is added if the name is taken. Return 
+    the new path. """
+    filename = os.path.basename(path)
+    target = os.path.join(folder, filename)
+    copy_no = 1
+    while os.path.exists(target):
+        copy_no += 1
+        target = os.path.join(folder, "{}_{}".format(copy_no, filename))
+    os.rename(path, target)
+    return target
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Format due diligence data for Mail Manager.")
+    parser.add_argument("inputs", nargs="*", metavar="inFile",
+                        help="fixed width TXT or Excel input files or globs")
+    parser.add_argument("--manifest", 
+                        help="text file listing one input file or glob per line")
+    parser.add_argument("--letter-code", type=str.upper, choices=LETTER_CODES,
+                        help="letter code for the GMC template, asked for when not given")
+    parser.add_argument("--output-dir", 
+                        help="write outputs here, prefixed with the input name")
+    parser.add_argument("--watch", metavar="INBOX",
+                        help="run as a service processing files dropped in INBOX")
+    parser.add_argument("--jobs", type=processCount, default=1,
+                        help="process this many input files at once")
+    parser.add_argument("--workers", type=processCount, default=1,
+                        help="parse a TXT file with this many processes")
+    # The _rev.xlsx is only a review copy. Skip it when 
+    # only the CSV/DAT deliverables are needed.
+    parser.add_argument("--no-xlsx", action="store_true",
+                        help="do not write the _rev.xlsx review workbook")
+    parser.add_argument("--xlsx-rows", type=xlsxRows, default=XLS_MAX_ROWS,
+                        help="records per _rev.xlsx worksheet before a new sheet "
+                             "is started (default and most {})".format(XLS_MAX_ROWS))
+    parser.add_argument("--xlsx-split-files", action="store_true",
+                        help="start a new _rev_N.xlsx file instead of a new sheet")
+    parser.add_argument("--concurrent-writers", action="store_true",
+                        help="write the outputs in parallel writer processes even on one CPU")
+    parser.add_argument("--profile", action="store_true",
+                        help="save a cProfile report of each file as PROFILE.pstats")
+    parser.add_argument("--delta", metavar="STORE",
+                        help="reuse records parsed by earlier runs, kept in this file")
+    parser.add_argument("--static-format", choices=STATIC_FORMATS.keys(), default="csv",
+                        help="write the Static Data as StaticData.dat (csv), compressed "
+                             "with gzip or zstd, or as a StaticData.cols column file")
+    parser.add_argument("--mailed-index", metavar="INDEX",
+                        help="reject records whose LT or Company + Account Number was "
+                             "mailed from another file, or is claimed by a run still in "
+                             "progress, as kept in this file")
+    parser.add_argument("--shards", type=shardCount,
+                        help="split AddressData.csv into this many files of about the "
+                             "same size, or one per AddressType with 'type', listed with "
+                             "their checksums in AddressData_MANIFEST.json")
+    parser.add_argument("--stage", action="store_true",
+                        help="keep the classified records in STAGE.db beside the outputs, "
+                             "for --from-stage")
+    parser.add_argument("--from-stage", metavar="STAGE",
+                        help="write the outputs again from a STAGE.db without parsing, "
+                             "with --letter-code to change the letter code")
+    parser.add_argument("--set-category", metavar="LT=TYPE", type=categoryChange, 
+                        action="append", default=[],
+                        help="with --from-stage, move the record with this LT to "
+                             "MEX, CAN, FGN or DOM")
+    parser.add_argument("--export", choices=STAGE_EXPORTS, action="append",
+                        help="with --from-stage, write only these outputs: csv for "
+                             "AddressData.csv and the Static Data, xlsx or counts")
+    args = parser.parse_args(argv)
+    if args.watch:
+        if args.inputs or args.manifest:
+            parser.error("--watch does not take input files")
+        if not args.letter_code:
+            parser.error("--watch needs --letter-code")
+        if args.workers > 1:
+            parser.error("--workers can not be used with --watch")
+    elif args.from_stage:
+        if args.inputs or args.manifest or args.stage:
+            parser.error("--from-stage does not take input files or --stage")
+    elif not args.inputs and not args.manifest:
+        parser.error("give input files or a --manifest")
+    if (args.set_category or args.export) and not args.from_stage:
+        parser.error("--set-category and --export need --from-stage")
+    if args.workers > 1 and args.jobs > 1:
+        parser.error("--workers can only be used with --jobs 1")
+    if args.static_format == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            parser.error("--static-format zstd needs the zstandard package")
+    if args.delta and args.workers > 1:
+        parser.error("--delta can not be combined with --workers")
+    return args
+
+
+def processCount(text):
+    """ The --jobs or --workers value, a number of processes. """
+    if not text.isdigit() or int(text) < 1:
+        raise argparse.ArgumentTypeError("expected a number of processes of 1 or more")
+    return int(text)
+
+
+def shardCount(text):
+    """ The --shards value, a number of shards or "type". """
+    if text.lower() == "type":
+        return "type"
+    if not text.isdigit() or int(text) < 1:
+        raise argparse.ArgumentTypeError("expected a number of shards or 'type'")
+    return int(text)
+
+
+def xlsxRows(text):
+    """ The --xlsx-rows value, a number of records a sheet holds. """
+    if not text.isdigit() or not 1 <= int(text) <= XLS_MAX_ROWS:
+        raise argparse.ArgumentTypeError("expected a number of rows from 1 to {}".format(
+            XLS_MAX_ROWS))
+    return int(text)
+
+
+def categoryChange(text):
+    """ The (LT, category) of a --set-category LT=TYPE. """
+    lt, sep, category = text.partition("=")
+    if not lt or category.upper() not in MAILING_ORDER:
+        raise argparse.ArgumentTypeError(
+            "expected LT=TYPE with TYPE one of {}".format(", ".join(MAILING_ORDER)))
+    return lt, category.upper()
 
 
 def replaceNonAsciiChars(text):
     """ Convert byte text to unicode chars. Replace non-ASCII,
     the "replacement", "non-breaking space" and "Broken Bar" 
-    chars. Convert chars back into bytes. """
+    chars. Convert chars back into bytes. 
     
-    char_text = text.decode("utf-8", errors='replace').replace(u'\ufffd', " ")
-    replace_nbspace = char_text.replace(u'\u00A6', " ")
-    replace_bknbar = replace_nbspace.replace(u'\u00A0', " ")
-    latin_text = replace_bknbar.encode("latin-1")
-    ascii_char = latin_text.decode("ascii", errors='replace').replace(u'\ufffd', " ")
-    byte_text = ascii_char.encode("ascii")
-    return byte_text
+    Pure ASCII text is returned as is. Otherwise every char 
+    in the latin-1 range, including the replacement char, 
+    becomes one space in a single translate pass. Chars past 
+    latin-1 raise UnicodeEncodeError as they always have. """
+    
+    if not text.translate(None, ASCII_BYTES):
+        return text
+    char_text = text.decode("utf-8", errors='replace').replace(u'\ufffd', u'\x80')
+    return char_text.encode("latin-1").translate(NON_ASCII_TO_SPACE)
 
 
 def create_data_fields():    
@@ -173,7 +936,7 @@ def chooseLetterCode():
     """ Select the LetterCode. Used to select the appropriate 
     template in GMC.
     """
-    letterCodeList = ["A", "AC", "FA", "FC", "R", "RC"]
+    letterCodeList = LETTER_CODES
     choiceString = "\n".join(["\nSelect letter code", 
                               "A = DDA", "AC = DDAC",
                               "FA = DDFA", "FC = DDFC",
@@ -193,73 +956,560 @@ def processTXT(inFile, static_hdr):
     code in the data with the selected letter code. Add foreign  
     or domestic to the record. Format the zip code. """
     
-    recordsList = []
+    return list(iterTXT(inFile, static_hdr))
+
+
+def iterTXT(inFile, static_hdr, workers=1, delta=None, rejects=None):
+    """ Generator version of processTXT. Yield each 
+    record as it is read from the fixed width file. With 
+    more than one worker the file is parsed in chunks by 
+    a process pool and the chunks are yielded in order. 
+    With a DeltaStore, lines seen in an earlier run are 
+    not parsed again. Malformed lines are appended to 
+    the rejects list, see iterTXTMapped. """
     
-    formatStr = "8s 6s 9s 40s 12s 8s 19s 40s 40s 40s 40s 40s 40s 40s 4s 36s 40s 9s 2s 14s 1s 2s 6s 20s"
-    fieldstruct = struct.Struct(formatStr)
-    parse = fieldstruct.unpack_from
+    if workers > 1:
+        for record in iterTXTParallel(inFile, static_hdr, workers, rejects):
+            yield record
+        return
     
+    if delta:
+        layout = readTXTLayout(inFile)
+        seed = "{} {}".format(layout.version, layout.format)
+        for record in delta.iterRecords(seed, iterTXTMapped(inFile, raw=True, rejects=rejects), 
+                                        layout.unpack):
+            yield record
+    else:
+        for record in iterTXTMapped(inFile, rejects=rejects):
+            yield record
+
+
+def parseTXTLine(line, layout=None):
+    # Remove extra spaces in fields 
+    ascii_line = replaceNonAsciiChars(line)
+    return (layout or TXT_LAYOUT).unpack(ascii_line)
+
+
+class TXTLayout(object):
+    """ One version of the fixed width TXT layout compiled for 
+    unpacking. When the fields are declared in static_hdr order 
+    the struct has a "0s" blank for each field left out and 
+    unpacks straight into a record. Otherwise it unpacks in file 
+    order, with one "0s" blank at the end, and the plan picks 
+    the values into static_hdr order. """
+    
+    def __init__(self, version, fields, static_hdr):
+        self.version = version
+        self.fields = fields
+        self.length = sum(field[1] for field in fields)
+        names = [field[0] for field in fields]
+        unknown = [name for name in names if name not in static_hdr]
+        if unknown:
+            raise ValueError("TXT layout {}: unknown fields {}".format(version, unknown))
+        
+        positions = [static_hdr.index(name) for name in names]
+        if positions == sorted(positions):
+            widths = dict((field[0], field[1]) for field in fields)
+            self.format = " ".join("{}s".format(widths.get(name, 0)) for name in static_hdr)
+            self.plan = None
+        else:
+            self.format = " ".join("{}s".format(field[1]) for field in fields) + " 0s"
+            self.plan = operator.itemgetter(*[names.index(name) if name in names else len(names) 
+                                              for name in static_hdr])
+        self.struct = struct.Struct(self.format)
+        self.transforms = [(static_hdr.index(field[0]), field[2]) 
+                           for field in fields if len(field) > 2]
+        # A plain layout is unpacked inline by iterTXTMapped
+        self.plain = self.plan is None and not self.transforms
+    
+    def unpack(self, data, offset=0):
+        values = self.struct.unpack_from(data, offset)
+        if self.plan:
+            values = self.plan(values)
+        record = [" ".join(x.split()) for x in values]
+        for idx, transform in self.transforms:
+            record[idx] = transform(record[idx])
+        return record
+
+
+def compileTXTLayouts(versions):
+    """ Compile the declared versions. The version of a file 
+    is found by its record length, so no two may share one. """
+    static_hdr = [f[0] for f in create_data_fields()]
+    layouts = [TXTLayout(version, fields, static_hdr) for version, fields in versions]
+    lengths = collections.Counter(layout.length for layout in layouts)
+    shared = [length for length, count in lengths.items() if count > 1]
+    if shared:
+        raise ValueError("TXT layouts share record lengths {}".format(shared))
+    return layouts
+
+
+TXT_LAYOUTS = compileTXTLayouts(TXT_LAYOUT_VERSIONS)
+# The current version, for lines parsed without a file to detect from
+TXT_LAYOUT = TXT_LAYOUTS[-1]
+
+
+def iterTXTMapped(inFile, start=0, end=None, raw=False, rejects=None):
+    """ Parse the records that start inside a byte range of the 
+    memory-mapped file. The layout version is found by the record 
+    length. Plain ASCII records that end in the line terminator 
+    are unpacked straight from the map at computed offsets, 
+    without a copy of the line or a cleaning pass. Other lines 
+    are sliced and cleaned as parseTXTLine does. A line longer 
+    than the layout is cut to it when the extra characters are 
+    blank. Other lines that are not the length of the layout 
+    once cleaned are reported by byte offset, skipped, and 
+    appended to rejects as (offset, line) with the line as it 
+    is in the file. With raw set, yield instead the bytes of 
+    each record's line and the cleaned record to unpack, as 
+    (line, (record,)) items for DeltaStore. """
+    
+    if os.path.getsize(inFile) == 0:
+        return
     with open(inFile, 'rb') as o:
-        for seq, line in enumerate(o, start=1):
-            ascii_line = replaceNonAsciiChars(line)
-            outputLine = [" ".join(x.split()) for x in parse(ascii_line)]
-            
-            # Remove extra spaces in fields 
-            # Add blanks for AddrLine8 and AddressType
-            outputLine.insert(static_hdr.index("NameAddress7"), "")
-            outputLine.append("")
-            recordsList.append(outputLine)
+        mapped = mmap.mmap(o.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        layout, terminator = detectTXTLayout(inFile, mapped)
+        record_length = layout.length
+        
+        file_size = len(mapped)
+        end = file_size if end is None else end
+        next_record = record_length + len(terminator)
+        unpack_from = layout.struct.unpack_from
+        plain = layout.plain
+        # marks flags the bytes from marks_start that need the slow path
+        marks, marks_start, marks_end = "", start, start
+        malformed = 0
+        offset = start
+        while offset < end:
+            record_end = offset + record_length
+            if record_end > marks_end:
+                marks_start = offset
+                marks = mapped[offset:offset + TXT_SCAN_SIZE].translate(SLOW_PATH_MARKS)
+                marks_end = marks_start + len(marks)
+            if (record_end <= file_size and 
+                    marks.find("\x01", offset - marks_start, record_end - marks_start) < 0 and 
+                    mapped[record_end:offset + next_record] == terminator):
+                if raw:
+                    line = mapped[offset:offset + next_record]
+                    yield line, (line,)
+                elif plain:
+                    yield [" ".join(x.split()) for x in unpack_from(mapped, offset)]
+                else:
+                    yield layout.unpack(mapped, offset)
+                offset += next_record
+                continue
             
-    return recordsList
+            line_end = mapped.find("\n", offset)
+            line_end = file_size if line_end == -1 else line_end + 1
+            line = mapped[offset:line_end]
+            ascii_line = replaceNonAsciiChars(stripTerminator(line))
+            if len(ascii_line) > record_length and not ascii_line[record_length:].strip():
+                ascii_line = ascii_line[:record_length]
+            if len(ascii_line) == record_length:
+                yield (line, (ascii_line,)) if raw else layout.unpack(ascii_line)
+            else:
+                malformed += 1
+                print "Malformed record at byte offset {}: {} characters, expected {}".format(
+                    offset, len(ascii_line), record_length)
+                if rejects is not None:
+                    rejects.append((offset, line))
+            offset = line_end
+        
+        if malformed:
+            print "Skipped {} malformed records in {}\n".format(malformed, inFile)
+    finally:
+        mapped.close()
+
+
+def readTXTLayout(inFile):
+    """ The layout version of a TXT file, found as 
+    iterTXTMapped finds it. """
+    if os.path.getsize(inFile) == 0:
+        return TXT_LAYOUT
+    with open(inFile, 'rb') as o:
+        mapped = mmap.mmap(o.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return detectTXTLayout(inFile, mapped)[0]
+    finally:
+        mapped.close()
+
+
+def detectTXTLayout(inFile, mapped):
+    """ The TXT layout matching the record length of the 
+    mapped file, and its line terminator. """
+    record_length, terminator = detectRecordLength(mapped)
+    for layout in TXT_LAYOUTS:
+        if layout.length == record_length:
+            return layout, terminator
+    raise ValueError("{}: the records are {} characters, no TXT layout matches ({})".format(
+        inFile, record_length, ", ".join("{} is {}".format(layout.version, layout.length) 
+                                         for layout in TXT_LAYOUTS)))
+
+
+def detectRecordLength(mapped, sample_lines=RECORD_LENGTH_SAMPLE):
+    """ The most common cleaned length of the first sample_lines 
+    lines, and the line terminator of the first line: "\r\n", 
+    "\n", or "" for a file of a single record. """
+    lengths = collections.Counter()
+    terminator = None
+    offset = 0
+    for _ in xrange(sample_lines):
+        line_end = mapped.find("\n", offset)
+        line = mapped[offset:] if line_end == -1 else mapped[offset:line_end + 1]
+        if not line:
+            break
+        record = stripTerminator(line)
+        if terminator is None:
+            terminator = line[len(record):]
+        lengths[len(replaceNonAsciiChars(record))] += 1
+        offset += len(line)
+    return lengths.most_common(1)[0][0], terminator
+
+
+def stripTerminator(line):
+    if line.endswith("\r\n"):
+        return line[:-2]
+    if line.endswith("\n"):
+        return line[:-1]
+    return line
+
+
+def iterTXTParallel(inFile, static_hdr, workers, rejects=None):
+    """ Parse the chunks of the file in a pool of workers and 
+    yield the records in file order. At most 
+    TXT_CHUNKS_PER_WORKER chunks per worker are in flight, so 
+    parsed chunks do not pile up while the records of the 
+    oldest are consumed. """
+    
+    chunks = iter([(inFile, start, end) 
+                   for start, end in findTXTChunks(inFile, TXT_CHUNK_SIZE)])
+    pool = multiprocessing.Pool(workers)
+    try:
+        window = collections.deque(pool.apply_async(parseTXTChunk, [chunk]) for chunk in 
+                                   itertools.islice(chunks, workers * TXT_CHUNKS_PER_WORKER))
+        while window:
+            records, chunk_rejects = window.popleft().get()
+            chunk = next(chunks, None)
+            if chunk:
+                window.append(pool.apply_async(parseTXTChunk, [chunk]))
+            if rejects is not None:
+                rejects.extend(chunk_rejects)
+            for record in records:
+                yield record
+            # Free the chunk before waiting for the next one
+            del records
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def findTXTChunks(inFile, chunk_size):
+    """ Split the file into (start, end) byte ranges of about 
+    chunk_size. Each boundary is moved forward to the start 
+    of the next line so no record is split between chunks. """
+    
+    file_size = os.path.getsize(inFile)
+    boundaries = [0]
+    with open(inFile, 'rb') as o:
+        for offset in xrange(chunk_size, file_size, chunk_size):
+            if offset <= boundaries[-1]:
+                continue
+            o.seek(offset - 1)
+            o.readline()
+            if o.tell() >= file_size:
+                break
+            boundaries.append(o.tell())
+    boundaries.append(file_size)
+    return zip(boundaries[:-1], boundaries[1:])
+
+
+def parseTXTChunk(args):
+    """ Pool worker. Parse the lines that start inside 
+    the byte range of one chunk. Return the records and 
+    the malformed lines. """
+    
+    inFile, start, end = args
+    rejects = []
+    return list(iterTXTMapped(inFile, start, end, rejects=rejects)), rejects
     
 
 def processXLSfromCSV(csv_file, us_dict, data_fields, static_hdr):
     """ Retrieve the records from the Excel. Arrange and 
     format the data to the standard layout. """
 
-    recordsList = []
+    return list(iterXLSfromCSV(csv_file, us_dict, data_fields, static_hdr))
+
+
+def iterXLSfromCSV(csv_file, us_dict, data_fields, static_hdr, delta=None):
+    """ Generator version of processXLSfromCSV. Yield each 
+    record as it is read. The CSV is deleted once exhausted. """
     
     with open(csv_file, 'rb') as csv_handle:
         csv_file_rdr = csv.reader(csv_handle, quoting=csv.QUOTE_ALL)
-        csv_hdr = csv_file_rdr.next()    
-        
-        field_indxs = getFieldsIndxs(csv_hdr, data_fields)
-        
-        for line in csv_file_rdr:
-            if line[:5].count("") == "":
-                break
-            else:
-                dataRow = getFieldValuesFromLine(line, field_indxs)
-                
-                ''' Look up the Escheatment State abbreviation in the 
-                US State Table. Replace with the full State Name. '''
-                escheat_idx = static_hdr.index("Escheatment State")
-                escheat_state = dataRow[escheat_idx]
-                dataRow[escheat_idx] = us_dict[escheat_state]    
-                
-                ''' If LT number is missing, create a substitute by 
-                combining the company and account numbers. '''
-                if dataRow[static_hdr.index("LT")] == "":
-                    compNo = dataRow[static_hdr.index("Company Number")]
-                    acctNo = dataRow[static_hdr.index("Account Number")]
-                    dataRow[static_hdr.index("LT")] = "{}{}".format(compNo, acctNo)
-                    
-                recordsList.append(dataRow)
+        for dataRow in iterXLSRows(csv_file_rdr, us_dict, data_fields, static_hdr, delta):
+            yield dataRow
                 
     os.remove(csv_file)
-    return recordsList   
+
+
+def iterXLSX(excel_file, us_dict, data_fields, static_hdr, delta=None):
+    """ Read the records straight from the workbook with 
+    openpyxl in read only mode. No temp CSV and no Excel 
+    process are needed, so this also runs off Windows. """
+    
+    import openpyxl
+    wb = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        # Cells, not values, so numbers keep their number format
+        rows = ws.iter_rows()
+        cell_rows = (formatExcelRow(row) for row in rows if not isEmptyExcelRow(row))
+        for dataRow in iterXLSRows(cell_rows, us_dict, data_fields, static_hdr, delta):
+            yield dataRow
+    finally:
+        wb.close()
+
+
+def isEmptyExcelRow(row):
+    """ Excel leaves blank rows out of the saved CSV. """
+    return all(cell.value is None or cell.value == "" for cell in row)
+
+
+def formatExcelRow(row):
+    """ Convert the cells to the text Excel writes when it 
+    saves the sheet as CSV. Numbers are written in their 
+    number format, so a ZIP formatted 00000 keeps its 
+    leading zero. Text is encoded to the Windows code page 
+    like the CSV, so replaceNonAsciiChars sees the same 
+    bytes. """
+    values = []
+    for cell in row:
+        value = cell.value
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            values.append(formatExcelNumber(value, cell.number_format))
+        else:
+            values.append(formatExcelValue(value))
+    return values
+
+
+def formatExcelValue(value):
+    if value is None:
+        return ""
+    elif isinstance(value, unicode):
+        return value.encode("cp1252", errors='replace')
+    elif isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    elif isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    elif isinstance(value, datetime.datetime):
+        if value.time() == datetime.time(0):
+            return "{}/{}/{}".format(value.month, value.day, value.year)
+        return "{}/{}/{} {}:{:02d}".format(value.month, value.day, value.year,
+                                           value.hour, value.minute)
+    elif isinstance(value, datetime.date):
+        return "{}/{}/{}".format(value.month, value.day, value.year)
+    return str(value)
+
+
+def formatExcelNumber(value, number_format):
+    """ The text Excel shows for a number in a number format. 
+    Digit placeholders, thousands separators, scaling, percent, 
+    literal text and the sections of the format are applied. 
+    Other formats, such as dates or scientific, are written 
+    as General. """
+    
+    if number_format not in EXCEL_FORMATS:
+        EXCEL_FORMATS[number_format] = compileExcelFormat(number_format)
+    sections = EXCEL_FORMATS[number_format]
+    if not sections:
+        return formatExcelValue(value)
+    
+    if any(condition for condition, tokens in sections):
+        # The first section whose condition holds, else the first without one
+        matches = [tokens for condition, tokens in sections 
+                   if condition is None or condition[0](value, condition[1])]
+        if not matches:
+            return formatExcelValue(value)
+        tokens, signed = matches[0], True
+    elif value < 0 and len(sections) > 1:
+        # The negative section shows the sign as its own text
+        tokens, signed = sections[1][1], False
+    elif value == 0 and len(sections) > 2:
+        tokens, signed = sections[2][1], False
+    else:
+        tokens, signed = sections[0][1], True
+    text = renderExcelNumber(abs(value), tokens)
+    return "-" + text if signed and value < 0 else text
+
+
+def compileExcelFormat(number_format):
+    """ The sections of a number format as (condition, tokens) 
+    pairs, or None if it is written as General. A condition is 
+    an (operator, number) pair and a token a (kind, character) 
+    pair, kind being "digit", ".", ",", "%" or "text". """
+    
+    if number_format.lower() == "general":
+        return None
+    sections = [[None, []]]
+    chars = iter(number_format)
+    for char in chars:
+        tokens = sections[-1][1]
+        if char == ";":
+            if len(sections) == 3:
+                # The fourth section is for text
+                break
+            sections.append([None, []])
+        elif char == '"':
+            tokens.append(("text", "".join(itertools.takewhile(lambda c: c != '"', chars))))
+        elif char == "\\":
+            tokens.append(("text", next(chars, "")))
+        elif char == "_":
+            # Space the width of the next character
+            next(chars, None)
+            tokens.append(("text", " "))
+        elif char == "*":
+            # Repeat the next character to fill the cell
+            next(chars, None)
+        elif char == "[":
+            bracket = "".join(itertools.takewhile(lambda c: c != "]", chars))
+            condition = EXCEL_CONDITION.match(bracket)
+            if condition:
+                sections[-1][0] = (EXCEL_CONDITION_OPS[condition.group(1)], 
+                                   float(condition.group(2)))
+            elif bracket.startswith("$"):
+                # Currency symbol and locale
+                tokens.append(("text", bracket[1:].split("-")[0]))
+            elif bracket[:1].lower() in "hms":
+                # Elapsed time
+                return None
+        elif char in "0#?":
+            tokens.append(("digit", char))
+        elif char == ".":
+            # Only the first point is the decimal point
+            tokens.append(("text", char) if (".", ".") in tokens else (".", char))
+        elif char in ",%":
+            tokens.append((char, char))
+        elif char.lower() in "eymdhsabg@/":
+            # Scientific, dates and times, General, text and fractions
+            return None
+        else:
+            tokens.append(("text", char))
+    return [tuple(section) for section in sections]
+
+
+def renderExcelNumber(value, tokens):
+    """ Fill the tokens of one format section with a number 
+    that is not negative. """
+    
+    kinds = [kind for kind, char in tokens]
+    point = kinds.index(".") if "." in kinds else len(tokens)
+    int_tokens, frac_tokens = tokens[:point], tokens[point + 1:]
+    digits_at = [i for i, (kind, char) in enumerate(int_tokens) if kind == "digit"]
+    last_digit = digits_at[-1] if digits_at else -1
+    # A comma between digits groups thousands, one after them scales by 1000
+    commas = [i for i, (kind, char) in enumerate(int_tokens) if kind == ","]
+    grouped = bool(digits_at) and any(digits_at[0] < i < last_digit for i in commas)
+    scale = len([i for i in commas if i > last_digit])
+    places = len([kind for kind, char in frac_tokens if kind == "digit"])
+    
+    number = decimal.Decimal(repr(value) if isinstance(value, float) else value)
+    number = number.scaleb(2 * kinds.count("%") - 3 * scale).quantize(
+        decimal.Decimal(1).scaleb(-places), rounding=decimal.ROUND_HALF_UP)
+    whole, _, fraction = "{:f}".format(number).partition(".")
+    whole = whole.lstrip("0").rjust(len([i for i in digits_at if int_tokens[i][1] == "0"]), "0")
+    if grouped:
+        whole = ",".join(whole[max(end - 3, 0):end] for end in range(len(whole), 0, -3)[::-1])
+    
+    # Digits fill the placeholders from the right, the first takes the rest
+    text = []
+    for i in reversed(range(len(int_tokens))):
+        kind, char = int_tokens[i]
+        if kind == "digit":
+            if grouped and i != digits_at[0]:
+                continue
+            take = whole if i == digits_at[0] else whole[-1:]
+            whole = whole[:len(whole) - len(take)]
+            text.append(take or (" " if char == "?" else ""))
+        elif kind != ",":
+            text.append(char)
+    text = "".join(reversed(text))
+    if point == len(tokens):
+        return text
+    
+    # Trailing zeros are dropped for # and blanked for ?
+    frac_text = [char if kind not in ("digit", ",") else "" for kind, char in frac_tokens]
+    slots = [i for i, (kind, char) in enumerate(frac_tokens) if kind == "digit"]
+    for n, i in enumerate(slots):
+        frac_text[i] = fraction[n]
+    for i in reversed(slots):
+        if frac_text[i] != "0" or frac_tokens[i][1] == "0":
+            break
+        frac_text[i] = " " if frac_tokens[i][1] == "?" else ""
+    return text + "." + "".join(frac_text)
+
+
+def iterXLSRows(rows, us_dict, data_fields, static_hdr, delta=None):
+    """ Arrange and format the Excel rows to the standard 
+    layout. The first row is the header. With a DeltaStore, 
+    rows seen in an earlier run are reused. """
+    
+    rows = iter(rows)
+    csv_hdr = rows.next()    
+    
+    field_indxs = getFieldsIndxs(csv_hdr, data_fields)
+    layout = RecordLayout(static_hdr)
+    
+    if delta:
+        # The header decides which cells land in which field
+        lines = ((marshal.dumps(line), (line, field_indxs, us_dict, layout)) 
+                 for line in rows)
+        for dataRow in delta.iterRecords(marshal.dumps(csv_hdr), lines, createXLSRecord):
+            yield dataRow
+        return
+    
+    for line in rows:
+        if line[:5].count("") == "":
+            break
+        else:
+            yield createXLSRecord(line, field_indxs, us_dict, layout)
+
+
+def createXLSRecord(line, field_indxs, us_dict, layout):
+    dataRow = getFieldValuesFromLine(line, field_indxs)
+    
+    ''' Look up the Escheatment State abbreviation in the 
+    US State Table. Replace with the full State Name. '''
+    escheat_state = dataRow[layout.escheat_idx]
+    dataRow[layout.escheat_idx] = us_dict[escheat_state]    
+    
+    ''' If LT number is missing, create a substitute by 
+    combining the company and account numbers. '''
+    if dataRow[layout.lt_idx] == "":
+        compNo = dataRow[layout.company_idx]
+        acctNo = dataRow[layout.account_idx]
+        dataRow[layout.lt_idx] = "{}{}".format(compNo, acctNo)
+        
+    return dataRow
 
     
 def convertXLStoCSV(outputDir, excel_file):
     """ Save Excel file to CSV. Create a temp VB script. 
     Run the script on the Excel file with Command Line. """
         
+    # Unique temp names so jobs sharing a folder do not collide
     excel_name = os.path.basename(excel_file)
-    csv_name = ".".join(excel_name.split(".")[:-1]) + ".csv"
-    csv_file = os.path.join(outputDir, csv_name)
+    csv_handle, csv_file = tempfile.mkstemp(
+        prefix=".".join(excel_name.split(".")[:-1]) + "-", suffix=".csv", dir=outputDir)
+    os.close(csv_handle)
     
     # Temp XLS to CSV vb script
-    temp_vb_script = os.path.join(outputDir, "tempXLStoCSV-DO_NOT_TOUCH.vbs")
+    vb_handle, temp_vb_script = tempfile.mkstemp(
+        prefix="tempXLStoCSV-", suffix="-DO_NOT_TOUCH.vbs", dir=outputDir)
+    os.close(vb_handle)
     vb_string = "\n".join(
     ["Dim oExcel",
      "Set oExcel = CreateObject(\"Excel.Application\")",
@@ -330,145 +1580,742 @@ def getFieldValuesFromLine(line, field_indxs):
     return asciiRow
 
 
-def createRecordsDict(recordsList, static_hdr, letterCode):    
+class RecordLayout(object):
+    """ Positions of the fields used in the hot loops, resolved 
+    from static_hdr once rather than with static_hdr.index() 
+    for every record. The NameAddress fields are contiguous, 
+    addr_start:addr_end slices all eight. A record longer than 
+    field_count carries its address in the next field, see 
+    DeltaStore. """
+    
+    __slots__ = ["lt_idx", "company_idx", "account_idx", "addr_start", "addr_end",
+                 "city_idx", "zip_idx", "state_idx", "letter_code_idx", "seq_idx", 
+                 "escheat_idx", "type_idx", "field_count"]
+    
+    def __init__(self, static_hdr):
+        self.lt_idx = static_hdr.index("LT")
+        self.company_idx = static_hdr.index("Company Number")
+        self.account_idx = static_hdr.index("Account Number")
+        self.addr_start = static_hdr.index("NameAddress1")
+        self.addr_end = static_hdr.index("NameAddress8")+1
+        self.city_idx = static_hdr.index("Mailing City")
+        self.zip_idx = static_hdr.index("Zip")
+        self.state_idx = static_hdr.index("Mailing State")
+        self.letter_code_idx = static_hdr.index("LetterCode")
+        self.seq_idx = static_hdr.index("Sequence")
+        self.escheat_idx = static_hdr.index("Escheatment State")
+        self.type_idx = static_hdr.index("AddressType")
+        self.field_count = len(static_hdr)
+
+
+class RecordSpool(object):
+    """ Temporary on-disk list of records for one mailing 
+    category. Records are appended as they are classified 
+    and read back in the same order when iterated. """
+    
+    def __init__(self):
+        self.handle = tempfile.TemporaryFile()
+        self.writer = csv.writer(self.handle)
+        self.count = 0
+        
+    def append(self, record):
+        self.writer.writerow(record)
+        self.count += 1
+        
+    def __len__(self):
+        return self.count
+        
+    def __iter__(self):
+        self.handle.flush()
+        self.handle.seek(0)
+        for record in csv.reader(self.handle):
+            yield record
+        self.handle.seek(0, os.SEEK_END)
+        
+    def close(self):
+        self.handle.close()
+
+
+class DeltaStore(object):
+    """ Records classified by earlier runs, in a SQLite file. 
+    The raw TXT lines or Excel rows are cut into chunks after 
+    each line whose CRC ends in DELTA_CHUNK_BITS zero bits, so 
+    a changed, inserted or deleted line only changes its own 
+    chunk. A chunk whose digest is stored comes back as its 
+    classified records, each with its Mail Manager address in 
+    one field after the static fields, so it skips parsing, 
+    createRecordsDict's rules, the classifier and the 
+    AddressBuilder. The records of other chunks are parsed, 
+    classified and given their address here, then stored as a 
+    new chunk. Their LT (or Company + Account Number) is kept 
+    with the CRC of the line to count them as changed or new. 
+    Old chunks are kept, they can only match identical input. """
+    
+    def __init__(self, path, static_hdr, classifier=None):
+        self.layout = RecordLayout(static_hdr)
+        self.builder = AddressBuilder(static_hdr)
+        self.classifier = classifier or COUNTRY_CLASSIFIER
+        self.db = sqlite3.connect(path, timeout=60)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != DELTA_STORE_VERSION:
+            # Earlier versions stored the records one by one
+            self.db.execute("DROP TABLE IF EXISTS records")
+            self.db.execute("DROP TABLE IF EXISTS chunks")
+            self.db.execute("DROP TABLE IF EXISTS record_keys")
+            self.db.execute("PRAGMA user_version = {}".format(DELTA_STORE_VERSION))
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks (digest BLOB PRIMARY KEY, records BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS record_keys (record_key TEXT PRIMARY KEY, "
+                        "line_crc INTEGER)")
+        self.db.commit()
+        self.total = 0
+        self.reused = 0
+        self.changed = 0
+        self.new = 0
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        
+    def iterRecords(self, seed, items, parse):
+        """ Yield the classified record for each (raw, args) item, 
+        stored or made by parse(*args) and classify. The seed is 
+        the layout or the header that decides how the raw input 
+        is parsed, every chunk digest starts with it. """
+        mask = (1 << DELTA_CHUNK_BITS) - 1
+        crc32 = zlib.crc32
+        chunk = []
+        crcs = []
+        digest = hashlib.md5(seed)
+        for raw, args in items:
+            crc = crc32(raw)
+            digest.update(raw)
+            chunk.append(args)
+            crcs.append(crc)
+            if crc & mask == 0 or len(chunk) == DELTA_CHUNK_MAX:
+                for record in self.chunkRecords(digest.digest(), chunk, crcs, parse):
+                    yield record
+                chunk = []
+                crcs = []
+                digest = hashlib.md5(seed)
+        if chunk:
+            for record in self.chunkRecords(digest.digest(), chunk, crcs, parse):
+                yield record
+                
+    def chunkRecords(self, digest, chunk, crcs, parse):
+        """ The records of one chunk, stored or parsed. """
+        self.total += len(chunk)
+        row = self.db.execute("SELECT records FROM chunks WHERE digest = ?", 
+                              (buffer(digest),)).fetchone()
+        if row is not None:
+            self.reused += len(chunk)
+            return marshal.loads(row[0])
+        
+        records = [parse(*args) for args in chunk]
+        self.classify(records)
+        keys = [self.recordKey(record) for record in records]
+        known = dict(selectIn(self.db, "SELECT record_key, line_crc FROM record_keys "
+                              "WHERE record_key IN ({})", list(set(keys))))
+        for key, crc in itertools.izip(keys, crcs):
+            if key not in known:
+                self.new += 1
+            elif known[key] != crc:
+                self.changed += 1
+        self.db.executemany("INSERT OR REPLACE INTO record_keys VALUES (?, ?)", 
+                            itertools.izip(keys, crcs))
+        self.db.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?)", 
+                        (buffer(digest), buffer(marshal.dumps(records))))
+        self.db.commit()
+        return records
+        
+    def classify(self, records):
+        """ Normalize and classify the new records as createRecordsDict 
+        and sortForeignByCountry do, then add their address. The 
+        classifier's time is kept in seconds and cpu_seconds too, 
+        since it is spent inside the parse stage. """
+        layout = self.layout
+        foreign = [record for record in records if normalizeRecord(record, layout)]
+        start, cpu_start = time.time(), cpuTime()
+        for record in foreign:
+            record[layout.type_idx] = foreignCategory(record, layout, self.classifier)
+        seconds, cpu_seconds = time.time() - start, cpuTime() - cpu_start
+        self.classifier.seconds += seconds
+        self.classifier.cpu_seconds += cpu_seconds
+        self.seconds += seconds
+        self.cpu_seconds += cpu_seconds
+        for record, address in itertools.izip(records, self.builder.build(records)):
+            record.append(ADDRESS_SEPARATOR.join(address))
+        
+    def recordKey(self, record):
+        lt = record[self.layout.lt_idx]
+        if lt:
+            return "LT:" + lt
+        return "ACCT:{}|{}".format(record[self.layout.company_idx], 
+                                   record[self.layout.account_idx])
+        
+    def report(self):
+        return "Delta: reused {} of {} records ({:.1f}%), {} changed, {} new".format(
+            self.reused, self.total, 100.0 * self.reused / self.total if self.total else 0.0, 
+            self.changed, self.new)
+        
+    def close(self):
+        self.db.close()
+
+
+class MailedIndex(object):
+    """ LT numbers and Company + Account Numbers mailed from 
+    earlier files, in a SQLite file shared between runs. A 
+    record with a key claimed by another file goes to 
+    REJECTS.dat instead of the outputs. Files are told apart 
+    by the SHA-256 of their contents: a rerun of a file does 
+    not reject its own records, a new file under the same name 
+    does. Each run claims the keys of the records it keeps and 
+    the first claim of a key wins. Keys claimed by a run still 
+    in progress are rejected too, so files run at the same 
+    time do not both mail a key. A run is marked mailed once 
+    its outputs are written. A run that fails releases its 
+    keys, as does one that has not updated the index for 
+    MAILED_RUN_TIMEOUT seconds. Keys are looked up and claimed 
+    MAILED_BATCH_SIZE records at a time, each batch in one 
+    write transaction. """
+    
+    def __init__(self, path, static_hdr, inFile, outputDir, prefix=""):
+        layout = RecordLayout(static_hdr)
+        self.keyFields = operator.itemgetter(layout.lt_idx, layout.company_idx, layout.account_idx)
+        self.field_count = layout.field_count
+        self.source = os.path.basename(inFile)
+        self.digest = fileDigest(inFile)
+        self.marked = False
+        self.touched = time.time()
+        # Transactions are begun and ended here, see transaction
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        with self.transaction():
+            # mailed is 1 for a mailed run, 0 in progress and -1 failed
+            self.db.execute("CREATE TABLE IF NOT EXISTS runs ("
+                            "id INTEGER PRIMARY KEY, source TEXT, started TEXT, mailed INTEGER)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS mailed (key TEXT PRIMARY KEY, run INTEGER)")
+            # Index files from before runs were told apart by content lack these
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(runs)")]
+            for column in ["digest TEXT", "updated REAL"]:
+                if column.split()[0] not in columns:
+                    self.db.execute("ALTER TABLE runs ADD COLUMN " + column)
+            self.db.execute("CREATE INDEX IF NOT EXISTS mailed_by_run ON mailed (run)")
+            
+            self.db.execute("UPDATE runs SET mailed = -1 WHERE mailed = 0 AND "
+                            "(updated IS NULL OR updated < ?)", 
+                            (time.time() - MAILED_RUN_TIMEOUT,))
+            self.db.execute("DELETE FROM mailed WHERE run IN "
+                            "(SELECT id FROM runs WHERE mailed = -1)")
+            self.run = self.db.execute("INSERT INTO runs (source, started, mailed, digest, updated) "
+                                       "VALUES (?, ?, 0, ?, ?)", 
+                                       (self.source, datetime.datetime.now().isoformat(), 
+                                        self.digest, time.time())).lastrowid
+        self.rejects_file = os.path.join(outputDir, prefix + "REJECTS.dat")
+        self.rejects = open(self.rejects_file, 'wb')
+        self.rejects_out = csv.writer(self.rejects, quoting=csv.QUOTE_ALL)
+        self.rejects_out.writerow(static_hdr + ["Duplicate Key", "Mailed From"])
+        self.checked = 0
+        self.rejected = 0
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        
+    @contextlib.contextmanager
+    def transaction(self):
+        """ A write transaction, so no other run claims keys 
+        between a lookup and the claims made from it. """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        
+    def iterUnmailed(self, records):
+        """ Yield the records whose keys are not claimed by 
+        another file or a run in progress, and write the 
+        others to the rejects. """
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, MAILED_BATCH_SIZE))
+            if not batch:
+                break
+            start, cpu_start = time.time(), cpuTime()
+            # The (LT, account) keys of each record, None when blank
+            keys = [("LT:" + lt if lt else None, 
+                     "ACCT:" + company + "|" + account if company or account else None) 
+                    for lt, company, account in itertools.imap(self.keyFields, batch)]
+            lookup = set(itertools.chain.from_iterable(keys))
+            lookup.discard(None)
+            
+            unmailed = []
+            with self.transaction():
+                # The claims this run can not mail past, by key
+                claimed = dict((key, source if mailed == 1 else source + " (in progress)") 
+                               for key, run, source, digest, mailed in selectIn(self.db, 
+                                   "SELECT mailed.key, runs.id, runs.source, runs.digest, "
+                                   "runs.mailed FROM mailed JOIN runs ON runs.id = mailed.run "
+                                   "WHERE mailed.key IN ({})", list(lookup)) 
+                               if run != self.run and (mailed == 0 or digest != self.digest))
+                pending = []
+                for record, record_keys in itertools.izip(batch, keys):
+                    found = [key for key in record_keys if key in claimed] if claimed else None
+                    if found:
+                        self.rejected += 1
+                        self.rejects_out.writerow(record[:self.field_count] + 
+                                                  [found[0], claimed[found[0]]])
+                    else:
+                        unmailed.append(record)
+                        pending.extend(key for key in record_keys if key)
+                # A key this file mailed before stays with the run that mailed it
+                self.db.executemany("INSERT OR IGNORE INTO mailed VALUES (?, ?)", 
+                                    ((key, self.run) for key in pending))
+                self.updateRun(0)
+            self.checked += len(batch)
+            self.seconds += time.time() - start
+            self.cpu_seconds += cpuTime() - cpu_start
+            
+            for record in unmailed:
+                yield record
+    
+    def touch(self):
+        """ Show the run is alive while its outputs are written, 
+        at most every MAILED_TOUCH_SECONDS. """
+        if time.time() - self.touched >= MAILED_TOUCH_SECONDS:
+            self.updateRun(0)
+            
+    def markMailed(self):
+        """ Mark the keys of this run mailed, once its 
+        outputs are written. """
+        self.updateRun(1)
+        self.marked = True
+        
+    def updateRun(self, mailed):
+        """ Set the run's mailed state and updated time. A run 
+        another run has taken to have crashed has lost its keys, 
+        so it fails rather than being mailed. """
+        self.touched = time.time()
+        if self.db.execute("UPDATE runs SET mailed = ?, updated = ? WHERE id = ? AND mailed = 0", 
+                           (mailed, self.touched, self.run)).rowcount == 0:
+            raise RuntimeError("The mailed index released this run's keys after {} seconds "
+                               "without an update".format(MAILED_RUN_TIMEOUT))
+        
+    def report(self):
+        return "Mailed index: rejected {} of {} records as claimed by another file, see {}".format(
+            self.rejected, self.checked, os.path.basename(self.rejects_file))
+        
+    def close(self):
+        """ Release the keys of a run that was not marked mailed. """
+        self.rejects.close()
+        try:
+            if not self.marked:
+                with self.transaction():
+                    self.db.execute("UPDATE runs SET mailed = -1 WHERE id = ?", (self.run,))
+                    self.db.execute("DELETE FROM mailed WHERE run = ?", (self.run,))
+        finally:
+            self.db.close()
+
+
+def fileDigest(path):
+    """ The SHA-256 of a file's contents, as hex. """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(TXT_SCAN_SIZE), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StageStore(object):
+    """ The parsed, normalized and classified records of a run, 
+    in a SQLite file that --from-stage exports from. Each record 
+    is kept marshalled beside indexed AddressType, LT and Sequence 
+    columns. The columns and the letter code of the stage win over 
+    the fields in the record, so a category or letter code change 
+    is a small update. Given static_hdr and the Job, a new stage 
+    is made, keeping the number of malformed TXT lines for 
+    COUNTS.txt, otherwise an existing one is opened. """
+    
+    def __init__(self, path, static_hdr=None, job=None, malformed=0):
+        if static_hdr is not None and os.path.exists(path):
+            os.remove(path)
+        elif static_hdr is None and not os.path.isfile(path):
+            raise ValueError("{} is not a stage file".format(path))
+        self.db = sqlite3.connect(path, timeout=60)
+        if static_hdr is not None:
+            self.db.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value BLOB)")
+            self.db.execute("CREATE TABLE records (id INTEGER PRIMARY KEY, "
+                            "AddressType TEXT, LT TEXT, Sequence INTEGER, record BLOB)")
+            self.db.executemany("INSERT INTO info VALUES (?, ?)", 
+                ((key, buffer(marshal.dumps(value))) for key, value in [
+                    ("static_hdr", static_hdr), ("letterCode", job.letterCode),
+                    ("filename", os.path.basename(job.inFile)), ("name", job.name), 
+                    ("prefix", job.prefix), ("malformed", malformed)]))
+            self.db.commit()
+        try:
+            info = dict((str(key), marshal.loads(value)) 
+                        for key, value in self.db.execute("SELECT key, value FROM info"))
+        except sqlite3.DatabaseError:
+            self.db.close()
+            raise ValueError("{} is not a stage file".format(path))
+        self.static_hdr = info["static_hdr"]
+        self.letterCode = info["letterCode"]
+        self.filename = info["filename"]
+        self.name = info["name"]
+        self.prefix = info["prefix"]
+        # Stages made before malformed lines were counted
+        self.malformed = info.get("malformed", 0)
+        self.layout = RecordLayout(self.static_hdr)
+        
+    def load(self, records_dict):
+        """ Stage the records in mailing order, with the Sequence 
+        iterSequenced gives them. The indexes are built after. A 
+        carried address is dropped, --set-category can change 
+        the category it was built for. """
+        type_idx, lt_idx, seq_idx = self.layout.type_idx, self.layout.lt_idx, self.layout.seq_idx
+        self.db.executemany("INSERT INTO records (AddressType, LT, Sequence, record) "
+                            "VALUES (?, ?, ?, ?)", 
+                            ((line[type_idx], line[lt_idx], line[seq_idx], 
+                              buffer(marshal.dumps(line))) 
+                             for line in staticRows(iterSequenced(records_dict, 
+                                                                  self.static_hdr), 
+                                                    self.static_hdr)))
+        self.db.execute("CREATE INDEX records_by_type ON records (AddressType, Sequence)")
+        self.db.execute("CREATE INDEX records_by_lt ON records (LT)")
+        self.db.execute("CREATE INDEX records_by_sequence ON records (Sequence)")
+        self.db.commit()
+        
+    def recordsDict(self):
+        """ A records_dict whose categories read from the stage. """
+        return dict((category, StagedCategory(self, category)) for category in MAILING_ORDER)
+        
+    def setLetterCode(self, letterCode):
+        self.letterCode = letterCode
+        self.db.execute("UPDATE info SET value = ? WHERE key = 'letterCode'", 
+                        (buffer(marshal.dumps(letterCode)),))
+        self.db.commit()
+        
+    def setCategory(self, lt, category):
+        """ Move the records with this LT to category. The moves 
+        are committed by resequence, once they are all made. """
+        if not self.db.execute("UPDATE records SET AddressType = ? WHERE LT = ?", 
+                               (category, lt)).rowcount:
+            raise ValueError("No staged record has LT {}".format(lt))
+        
+    def resequence(self):
+        """ Number the records from 1 again in mailing order. A 
+        record moved to another category keeps its place relative 
+        to the records around it by its old Sequence. """
+        order = [row for category in MAILING_ORDER 
+                 for row in self.db.execute("SELECT id, Sequence FROM records WHERE "
+                                            "AddressType = ? ORDER BY Sequence", (category,))]
+        self.db.executemany("UPDATE records SET Sequence = ? WHERE id = ?", 
+                            ((seq, row_id) for seq, (row_id, old_seq) in 
+                             enumerate(order, start=1) if seq != old_seq))
+        self.db.commit()
+        
+    def close(self):
+        self.db.close()
+
+
+class StagedCategory(object):
+    """ The records of one category of a StageStore in Sequence 
+    order, used like a RecordSpool. The count is an indexed 
+    COUNT(*), nothing is read to get it. """
+    
+    def __init__(self, stage, category):
+        self.stage = stage
+        self.category = category
+        
+    def __len__(self):
+        return self.stage.db.execute("SELECT COUNT(*) FROM records WHERE AddressType = ?", 
+                                     (self.category,)).fetchone()[0]
+        
+    def __iter__(self):
+        layout = self.stage.layout
+        letter_code_idx, type_idx, seq_idx = layout.letter_code_idx, layout.type_idx, layout.seq_idx
+        letterCode = self.stage.letterCode
+        category = self.category
+        for seq, record in self.stage.db.execute("SELECT Sequence, record FROM records "
+                                                 "WHERE AddressType = ? ORDER BY Sequence", 
+                                                 (category,)):
+            line = marshal.loads(record)
+            line[letter_code_idx] = letterCode
+            line[type_idx] = category
+            line[seq_idx] = seq
+            yield line
+            
+    def close(self):
+        pass
+
+
+def selectIn(db, query, params):
+    """ Run query with its IN list filled from params, a few 
+    hundred at a time to stay under SQLite's parameter limit. """
+    for i in xrange(0, len(params), 500):
+        chunk = params[i:i + 500]
+        sql = query.format(",".join("?" * len(chunk)))
+        for row in db.execute(sql, chunk):
+            yield row
+
+
+def createRecordsDict(recordsList, static_hdr, letterCode, spool=False):    
     """ Sort Record List into mailing categories. 
-    Fix Zip for domestic addresses as needed. """
+    Fix Zip for domestic addresses as needed. When spool is 
+    set, each category is kept in a RecordSpool on disk 
+    instead of a list. """
     
-    records_dict = {"MEX" : [], "CAN" : [],
-                    "FGN" : [], "DOM" : []}
+    if spool:
+        records_dict = {"MEX" : RecordSpool(), "CAN" : RecordSpool(),
+                        "FGN" : RecordSpool(), "DOM" : RecordSpool()}
+        foreignData = ForeignSorter(static_hdr)
+    else:
+        records_dict = {"MEX" : [], "CAN" : [],
+                        "FGN" : [], "DOM" : []}
+        foreignData = []
     
-    foreignData = []
+    layout = RecordLayout(static_hdr)
     
+    field_count = layout.field_count
     for dataRow in recordsList:
         # Add the Letter Code to the record.     
-        dataRow[static_hdr.index("LetterCode")] = letterCode
+        dataRow[layout.letter_code_idx] = letterCode
         
-        if dataRow[static_hdr.index("Mailing State")] == "FO":
-            dataRow[static_hdr.index("Zip")] = ""
+        if len(dataRow) > field_count:
+            # Classified by a DeltaStore
+            if dataRow[layout.type_idx] == "DOM":
+                records_dict["DOM"].append(dataRow)
+            else:
+                foreignData.append(dataRow)
+        elif normalizeRecord(dataRow, layout):
             foreignData.append(dataRow)
         else:
-            zip = dataRow[static_hdr.index("Zip")]
-            if len(zip) > 5 and "-" not in zip:
-                zip = "{}-{}".format(zip[:5], zip[5:])
-            dataRow[static_hdr.index("Zip")] = zip
-            dataRow[static_hdr.index("AddressType")] = "DOM"
             records_dict["DOM"].append(dataRow)
     
-    sortForeignByCountry(foreignData, records_dict, static_hdr)
+    if spool:
+        sortForeignByCountry(foreignData.iterSorted(), records_dict, static_hdr, presorted=True)
+        foreignData.close()
+    else:
+        sortForeignByCountry(foreignData, records_dict, static_hdr)
     
     return records_dict
 
 
-def sortForeignByCountry(foreignData, records_dict, static_hdr):
-    """ Sort foreign data into Mexico, Canada and  
-    other foreign countries by reviewing the mailing 
-    city and last of the address lines. """
+def normalizeRecord(dataRow, layout):
+    """ Blank the zip of a foreign record, or hyphenate the 
+    ZIP+4 of a domestic one and mark it DOM. Return whether 
+    the record is foreign. """
+    if dataRow[layout.state_idx] == "FO":
+        dataRow[layout.zip_idx] = ""
+        return True
+    zip = dataRow[layout.zip_idx]
+    if len(zip) > 5 and "-" not in zip:
+        dataRow[layout.zip_idx] = "{}-{}".format(zip[:5], zip[5:])
+    dataRow[layout.type_idx] = "DOM"
+    return False
 
-    canada_provinces = "\\b" + "\\b|\\b".join(["Canada","Alberta","Calgary","Edmonton",
-    "Strathcona County","British Columbia","Vancouver","Surrey","Burnaby","Manitoba",
-    "Winnipeg","Brandon","Springfield","New Brunswick","Moncton","Saint John","Fredericton",
-    "Newfoundland and Labrador","St. John's","Conception Bay South","Mount Pearl",
-    "Northwest Territories","Yellowknife","Hay River","Inuvik","Nova Scotia",
-    "Halifax","Sydney","Lunenburg","Nunavut","Iqaluit","Arviat","Rankin Inlet",
-    "Ontario","Toronto","Ottawa","Mississauga","Prince Edward Island","Charlottetown",
-    "Summerside","Stratford","Quebec","Montreal","Quebec City","Laval","Saskatchewan",
-    "Saskatoon","Regina","Prince Albert","Yukon","Whitehorse","Dawson City","Faro"]) + "\\b" 
+
+class ForeignSorter(object):
+    """ External sort of the foreign records by mailing city. 
+    Records are collected in runs of SORT_RUN_SIZE, each run is 
+    sorted and spilled to a RecordSpool, and the runs are merged 
+    back in order. Ties keep their input order, the same as the 
+    in-memory sorted() used by sortForeignByCountry. """
     
-    mexico_states_cities = "\\b" + "\\b|\\b".join(["Chihuahua","Sonora","Coahuila",
-    "Durango","Oaxaca","Tamaulipas","Jalisco","Zacatecas","Baja California Sur",
-    "Chiapas","Veracruz","Baja California","Nuevo Leon","Guerrero","San Luis Potosi",
-    "Michoacan","Sinaloa","Campeche","Quintana Roo","Yucatan","Puebla","Guanajuato",
-    "Nayarit","Tabasco","Mexico","Hidalgo","Queretaro","Colima","Aguascalientes",
-    "Morelos","Tlaxcala","Ciudad de Mexico","Mexico City","Ecatepec","Guadalajara",
-    "Puebla","Juarez","Tijuana","Leon","Monterrey","Zapopan","Nezahualcoyotl","Culiacan",
-    "Chihuahua","Naucalpan","Merida","San Luis Potosi","Aguascalientes","Hermosillo",
-    "Saltillo","Mexicali","Guadalupe","Acapulco","Tlalnepantla","Cancun","Queretaro",
-    "Chimalhuacan","Torreon","Morelia","Reynosa","Tlaquepaque","Tuxtla Gutierrez",
-    "Durango","Toluca","Ciudad Lopez Mateos","Cuautitlan Izcalli","Ciudad Apodaca","Matamoros",
-    "San Nicolas de los Garza","Veracruz","Xalapa","Tonala","Mazatlan","Irapuato",
-    "Nuevo Laredo","Xico","Villahermosa","General Escobedo","Celaya","Cuernavaca","Tepic",
-    "Ixtapaluca","Ciudad Victoria","Ciudad Obregon","Tampico","Ciudad Nicolas Romero",
-    "Ensenada","Coacalco de Berriozabal","Santa Catarina","Uruapan","Gomez Palacio",
-    "Los Mochis","Pachuca","Oaxaca","Soledad de Graciano Sanchez","Tehuacan","Ojo de Agua",
-    "Coatzacoalcos","Campeche","Monclova","La Paz","Nogales","Buenavista","Puerto Vallarta",
-    "Tapachula","Ciudad Madero","San Pablo de las Salinas","Chilpancingo","Poza Rica",
-    "Chicoloapan de Juarez","Ciudad del Carmen","Chalco de Diaz Covarrubias","Jiutepec",
-    "Salamanca","San Luis Rio Colorado","Cuautla","Ciudad Benito Juarez","Chetumal",
-    "Piedras Negras","Playa del Carmen","Zamora","Cordoba","San Juan del Rio","Colima",
-    "Ciudad Acuna","Manzanillo","Zacatecas","Veracruz","Ciudad Valles","Guadalupe",
-    "San Pedro Garza Garcia","Naucalpan","Fresnillo","Orizaba","Miramar","Iguala",
-    "Delicias","Ciudad de Villa de alvarez","Ciudad Cuauhtemoc","Navojoa","Guaymas",
-    "Minatitlan","Cuautitlan","Texcoco","Hidalgo del Parral","Tepexpan","Tulancingo"]) + "\\b"
+    def __init__(self, static_hdr, run_size=None):
+        self.city_idx = static_hdr.index("Mailing City")
+        self.run_size = run_size or SORT_RUN_SIZE
+        self.buffer = []
+        self.runs = []
+        
+    def append(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.run_size:
+            self.spillRun()
+            
+    def spillRun(self):
+        run = RecordSpool()
+        for record in sorted(self.buffer, key=lambda row: row[self.city_idx]):
+            run.append(record)
+        self.runs.append(run)
+        self.buffer = []
+        
+    def iterSorted(self):
+        """ Yield all records in mailing city order. """
+        if not self.runs:
+            for record in sorted(self.buffer, key=lambda row: row[self.city_idx]):
+                yield record
+            return
+            
+        if self.buffer:
+            self.spillRun()
+            
+        # Decorate with the run and position so that equal 
+        # cities are never compared on the record itself.
+        decorated = [self.decorateRun(run_no, run) 
+                     for run_no, run in enumerate(self.runs)]
+        for city, run_no, pos, record in heapq.merge(*decorated):
+            yield record
+            
+    def decorateRun(self, run_no, run):
+        for pos, record in enumerate(run):
+            yield (record[self.city_idx], run_no, pos, record)
+            
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+
+def placesPattern(places):
+    """ Compile the place names into one \\b delimited pattern, 
+    see placesRegex. """
+    return re.compile(placesRegex(places), flags=re.IGNORECASE)
+
+
+def placesRegex(places):
+    """ The place names as one \\b delimited regex. The names 
+    are folded into a prefix trie so the regex tests each 
+    shared prefix once instead of trying every name in turn. 
+    It matches the same text as joining the names with 
+    "\\b|\\b", ignoring case. """
     
-    city_idx = static_hdr.index("Mailing City")
-    addr_start = static_hdr.index("NameAddress1")
-    addr_end = static_hdr.index("NameAddress8")+1
+    trie = {}
+    for place in places:
+        node = trie
+        for char in place.lower():
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return r"\b" + trieToRegex(trie) + r"\b"
+
+
+def trieToRegex(node):
+    ending = "" in node
+    branches = [re.escape(char) + trieToRegex(child) 
+                for char, child in sorted(node.items()) if char != ""]
+    if not branches:
+        return ""
+    if len(branches) == 1 and not ending:
+        return branches[0]
+    pattern = "(?:" + "|".join(branches) + ")"
+    return pattern + "?" if ending else pattern
+
 
-    canada_zip_pattern = re.compile(r'\b[ABCEGHJ-NPRSTVXY][0-9][ABCEGHJ-NPRSTV-Z](\s|-)?[0-9][ABCEGHJ-NPRSTV-Z][0-9]\b', flags=re.IGNORECASE)
-    canada_prov_pattern = re.compile(canada_provinces, flags=re.IGNORECASE)
-    canada_major_cities_pattern = re.compile(r'\bCANADA\b|\bTORONTO\b|\bONTARIO\b|\bQUEBEC\b|\bALBERTA\b|\bMONTREAL\b', flags=re.IGNORECASE)
-    ontario_quebec_abbv_pattern = re.compile(r'(\bON\b)|(\bQC\b)\s\b[ABCEGHJ-NPRSTVXY][0-9][ABCEGHJ-NPRSTV-Z]', flags=re.IGNORECASE)
+class CountryClassifier(object):
+    """ Decide CAN, MEX or FGN for a foreign record from its 
+    mailing city and last address line. The patterns are 
+    compiled once and decisions are memoized, since foreign 
+    files repeat the same cities. Keeps a count, cache hits 
+    and wall and CPU time spent so the classification rate 
+    can be tracked. """
     
-    mexico_states_cities_pattern = re.compile(mexico_states_cities, flags=re.IGNORECASE)
+    def __init__(self, cache_size=CLASSIFIER_CACHE_SIZE):
+        self.canada_zip_pattern = re.compile(r'\b[ABCEGHJ-NPRSTVXY][0-9][ABCEGHJ-NPRSTV-Z](\s|-)?[0-9][ABCEGHJ-NPRSTV-Z][0-9]\b', flags=re.IGNORECASE)
+        self.canada_prov_pattern = placesPattern(CANADA_PLACES)
+        self.canada_major_cities_pattern = re.compile(r'\bCANADA\b|\bTORONTO\b|\bONTARIO\b|\bQUEBEC\b|\bALBERTA\b|\bMONTREAL\b', flags=re.IGNORECASE)
+        self.ontario_quebec_abbv_pattern = re.compile(r'(\bON\b)|(\bQC\b)\s\b[ABCEGHJ-NPRSTVXY][0-9][ABCEGHJ-NPRSTV-Z]', flags=re.IGNORECASE)
+        self.not_canada_pattern = re.compile(r'\bLONDON\b|\bUK\b|\bUNIT\b|\bGBR\b|\bAUS(TRALIA)?\b', flags=re.IGNORECASE)
+        
+        self.mexico_states_cities_pattern = placesPattern(MEXICO_PLACES)
+        self.not_mexico_pattern = re.compile(r'\bSPAIN\b|\bESPANA\b|\bITALY\b', flags=re.IGNORECASE)
+        
+        self.cache_size = cache_size
+        self.cache = {}
+        self.count = 0
+        self.cache_hits = 0
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        
+    def classify(self, record_city, last_addr_field):
+        self.count += 1
+        key = (record_city, last_addr_field)
+        category = self.cache.get(key)
+        if category is not None:
+            self.cache_hits += 1
+            return category
+        
+        category = self.decide(record_city, last_addr_field)
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[key] = category
+        return category
+        
+    def decide(self, record_city, last_addr_field):
+        # Check for country pattern and check that 
+        # it is not another country that has similar names
+        if (self.canada_zip_pattern.search(record_city) or 
+            self.ontario_quebec_abbv_pattern.search(record_city) or 
+            self.canada_major_cities_pattern.search(last_addr_field) or 
+            self.canada_prov_pattern.search(record_city)) and not \
+            self.not_canada_pattern.search(record_city):
+            return "CAN"
+        elif self.mexico_states_cities_pattern.search(record_city) and not \
+            self.not_mexico_pattern.search(record_city):
+            return "MEX"
+        return "FGN"
+        
+    def rate(self):
+        """ Records classified per second. """
+        return self.count / self.seconds if self.seconds else 0.0
+
+
+COUNTRY_CLASSIFIER = CountryClassifier()
+
+
+def sortForeignByCountry(foreignData, records_dict, static_hdr, presorted=False, 
+                         classifier=None):
+    """ Sort foreign data into Mexico, Canada and  
+    other foreign countries by reviewing the mailing 
+    city and last of the address lines. Set presorted 
+    when foreignData is already in mailing city order. """
+
+    classifier = classifier or COUNTRY_CLASSIFIER
+    
+    layout = RecordLayout(static_hdr)
+    city_idx = layout.city_idx
+    type_idx = layout.type_idx
+    field_count = layout.field_count
     
     # Sort by countries
-    sorted_foreign = sorted(foreignData, key=lambda row: row[city_idx]) 
+    if presorted:
+        sorted_foreign = foreignData
+    else:
+        sorted_foreign = sorted(foreignData, key=lambda row: row[city_idx]) 
     
     # Sort to Canada, Mexico and Other Foreign
+    start, cpu_start = time.time(), cpuTime()
     for record in sorted_foreign:
-        addrfields = [f for f in record[addr_start:addr_end] if f.upper() not in ["","NULL"]]
-        last_addr_field = addrfields[-1]
-        record_city = record[city_idx]
-        
-        # Check for country pattern and check that 
-        # it is not another country that has similar names
-        if (re.search(canada_zip_pattern, record_city) or \
-        re.search(ontario_quebec_abbv_pattern, record_city) or \
-        re.search(canada_major_cities_pattern, last_addr_field) or \
-        re.search(canada_prov_pattern, record_city)) and not\
-        (re.search(r'\bLONDON\b|\bUK\b|\bUNIT\b|\bGBR\b|\bAUS(TRALIA)?\b', record_city, flags=re.IGNORECASE)):
-        
-            record[static_hdr.index("AddressType")] = "CAN"
-            records_dict["CAN"].append(record)
-            
-        elif (re.search(mexico_states_cities_pattern, record_city)) and not \
-        (re.search(r'\bSPAIN\b|\bESPANA\b|\bITALY\b', record_city, flags=re.IGNORECASE)):
-        
-            record[static_hdr.index("AddressType")] = "MEX"
-            records_dict["MEX"].append(record)
-        else:    
-            record[static_hdr.index("AddressType")] = "FGN"
-            records_dict["FGN"].append(record)     
+        if len(record) > field_count:
+            # Classified by a DeltaStore
+            category = record[type_idx]
+        else:
+            category = foreignCategory(record, layout, classifier)
+            record[type_idx] = category
+        records_dict[category].append(record)
+    classifier.seconds += time.time() - start
+    classifier.cpu_seconds += cpuTime() - cpu_start
+
+
+def foreignCategory(record, layout, classifier):
+    """ CAN, MEX or FGN for a foreign record, by its mailing 
+    city and the last of its address lines. """
+    addrfields = [f for f in record[layout.addr_start:layout.addr_end] 
+                  if f.upper() not in ["","NULL"]]
+    return classifier.classify(record[layout.city_idx], addrfields[-1])
 
 
-def createMMAddress(line, static_hdr):
+def createMMAddress(line, static_hdr, layout=None):
     """ Extract needed fields from the static data to create 
     the BCC data. Move last line of the Name/Address fields 
-    to the Delivery or Alternate Address position. """
+    to the Delivery or Alternate Address position. Pass the 
+    RecordLayout of static_hdr when calling once per record. """
+    
+    layout = layout or RecordLayout(static_hdr)
     
     ''' Create new line from data '''
-    mmfields = [
-        line[static_hdr.index("NameAddress1")],
-        line[static_hdr.index("NameAddress2")],
-        line[static_hdr.index("NameAddress3")],
-        line[static_hdr.index("NameAddress4")],
-        line[static_hdr.index("NameAddress5")],
-        line[static_hdr.index("NameAddress6")],
-        line[static_hdr.index("NameAddress7")],
-        line[static_hdr.index("NameAddress8")],
-        line[static_hdr.index("Mailing City")],
-        line[static_hdr.index("Mailing State")],
-        line[static_hdr.index("Zip")]
-        ] 
-        
-    namesAndStreet = mmfields[:8]
+    namesAndStreet = line[layout.addr_start:layout.addr_end]
     namesAndStreet_NoBlanks = [f for f in namesAndStreet if f.upper() not in ["","NULL"]]
-    city = mmfields[8]
-    cityStateZip = mmfields[8:]
+    city = line[layout.city_idx]
+    cityStateZip = [city, line[layout.state_idx], line[layout.zip_idx]]
 
     ''' Find last line of name/address lines 
     and move Delivery/Alternate Addr position '''
-    if line[static_hdr.index("AddressType")] in ["MEX","CAN","FGN"]:
+    if line[layout.type_idx] in ["MEX","CAN","FGN"]:
         return formatForeignAddress(namesAndStreet_NoBlanks, city)   
     else:    
         return formatDomesticAddress(namesAndStreet_NoBlanks, cityStateZip)
@@ -492,11 +2339,11 @@ def formatDomesticAddress(namesAndStreet_NoBlanks, cityStateZip):
         alternateAddr = ""
         return namesAndStreet_NoBlanks + spaceShift + [deliveryAddr, alternateAddr] + cityStateZip
     else:
-        apt_pattern = re.compile(r'^((#|B(UI)?LD(IN)?G|SUITE|LOT|UNIT|FLOOR|R(OO)?M|AP(ARTMEN)?T).+|(\d{1,4}\s?\w)|(\d{1,3}(ST|ND|RD|TH)?\s?FL(OO)?R?))$', flags=re.IGNORECASE)
         deliveryAddr = namesAndStreet_NoBlanks[-1]
         
-        addrIdx = -2 if apt_pattern.match(deliveryAddr) and len(namesAndStreet_NoBlanks) > 2 else -1
-        alternateAddr = namesAndStreet_NoBlanks[-1] if apt_pattern.match(deliveryAddr) and len(namesAndStreet_NoBlanks) > 2 else ""
+        is_apt = len(namesAndStreet_NoBlanks) > 2 and APT_PATTERN.match(deliveryAddr)
+        addrIdx = -2 if is_apt else -1
+        alternateAddr = namesAndStreet_NoBlanks[-1] if is_apt else ""
         nameLines = namesAndStreet_NoBlanks[:addrIdx]
         spacesShift = [""] * (8 - len(nameLines))
         deliveryAddr = namesAndStreet_NoBlanks[addrIdx]
@@ -504,59 +2351,510 @@ def formatDomesticAddress(namesAndStreet_NoBlanks, cityStateZip):
         return nameLines + spacesShift + [deliveryAddr, alternateAddr] + cityStateZip
 
 
-def writeRecordsToCSV(outputDir, records_dict, static_hdr):                        
-    with open(os.path.join(outputDir, "AddressData.csv"), 'wb') as a:
-        with open(os.path.join(outputDir, "StaticData.dat"), 'wb') as s:
-                
-                addr_hdr = ["IM barcode Digits", "OEL", "Sack and Pack Numbers",
-                "Presort Sequence", "Full Name", "Name2", "Name3", 
-                "Name4","Name5","Name6","Name7","Name8","Delivery Address",
-                "Alternate 1 Address","City","State","ZIP+4","LTNo","SEQ"]
-                
-                AddressOut = csv.writer(a, quoting=csv.QUOTE_ALL)
-                AddressOut.writerow(addr_hdr)
-                
-                StaticOut = csv.writer(s, quoting=csv.QUOTE_ALL)
-                StaticOut.writerow(static_hdr)
-                
-                # Combine records into single list
-                all_records = []
-                for category in ["MEX", "CAN", "FGN", "DOM"]:
-                    all_records.extend(records_dict[category])
-                
-                for seq, line in enumerate(all_records, start=1):
-                    line[static_hdr.index("Sequence")] = seq
+class AddressBuilder(object):
+    """ createMMAddress for chunks of records. The Name/Address 
+    lines are filtered with a set lookup, and whether the last 
+    line is an apartment line is remembered per string, since 
+    "APT 1", "SUITE 100" and the like repeat across a file. The 
+    columns are the same as createMMAddress returns. A record 
+    from a DeltaStore already carries its address. """
+    
+    def __init__(self, static_hdr, cache_size=ADDRESS_CACHE_SIZE):
+        self.layout = RecordLayout(static_hdr)
+        self.cache_size = cache_size
+        self.apt_lines = {}
+        
+    def addressRows(self, records):
+        """ The AddressData.csv rows of a chunk of sequenced records. """
+        layout = self.layout
+        seq_idx = layout.seq_idx
+        lt_idx = layout.lt_idx
+        return [["", "", "", line[seq_idx]] + address + [line[lt_idx], line[seq_idx]] 
+                for line, address in itertools.izip(records, self.build(records))]
+        
+    def build(self, records):
+        """ The Mail Manager address of each record in the chunk. """
+        if len(self.apt_lines) > self.cache_size:
+            self.apt_lines.clear()
+        apt_lines = self.apt_lines
+        layout = self.layout
+        addr_start, addr_end = layout.addr_start, layout.addr_end
+        city_idx, state_idx, zip_idx = layout.city_idx, layout.state_idx, layout.zip_idx
+        type_idx = layout.type_idx
+        field_count = layout.field_count
+        
+        addresses = []
+        for line in records:
+            if len(line) > field_count:
+                addresses.append(line[field_count].split(ADDRESS_SEPARATOR))
+                continue
+            lines = [f for f in line[addr_start:addr_end] if f not in BLANK_ADDRESS_LINES]
+            if line[type_idx] in ("MEX", "CAN", "FGN"):
+                lines.append(line[city_idx])
+                address = lines + [""] * (8 - len(lines)) + ["", "", "", "", ""]
+            elif len(lines) < 2:
+                address = lines + [""] * (10 - len(lines)) + [
+                    line[city_idx], line[state_idx], line[zip_idx]]
+            else:
+                last = lines[-1]
+                is_apt = apt_lines.get(last)
+                if is_apt is None:
+                    is_apt = apt_lines[last] = APT_PATTERN.match(last) is not None
+                if is_apt and len(lines) > 2:
+                    address = lines[:-2] + [""] * (10 - len(lines)) + [
+                        lines[-2], last, line[city_idx], line[state_idx], line[zip_idx]]
+                else:
+                    address = lines[:-1] + [""] * (9 - len(lines)) + [
+                        last, "", line[city_idx], line[state_idx], line[zip_idx]]
+            addresses.append(address)
+        return addresses
+
+
+def iterChunks(records, chunk_size):
+    """ Lists of up to chunk_size records. """
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
 
-                    # Write address and Static Data
-                    LTNo = line[static_hdr.index("LT")]
-                    mmAddress = createMMAddress(line, static_hdr)                            
-                    AddressOut.writerow(["", "", "", seq] + mmAddress + [LTNo] + [seq])
-                    
-                    StaticOut.writerow(line)
+def staticRows(records, static_hdr):
+    """ The records without the address a DeltaStore record 
+    carries after the static fields. """
+    field_count = len(static_hdr)
+    for line in records:
+        yield line[:field_count] if len(line) > field_count else line
+
+
+def iterAllRecords(records_dict):
+    """ Chain the categories together in mailing order 
+    without combining them into a single list. """
+    return itertools.chain(*[records_dict[category] for category in MAILING_ORDER])
+
+
+def writeRecordsToCSV(outputDir, records_dict, static_hdr, prefix="", static_format="csv", 
+                      shards=None, progress=None):                        
+    """ Write AddressData.csv, or with shards its shard files and 
+    manifest, and the Static Data. progress is as for 
+    iterSequenced. """
+    
+    plan = planShards(records_dict, shards, prefix)
+    starts = [shard.first_sequence for shard in plan]
+    seq_idx = static_hdr.index("Sequence")
+    files = []
+    StaticOut = openStaticData(outputDir, prefix, static_hdr, static_format)
+    try:
+        AddressOuts = []
+        for shard in plan:
+            files.append(open(os.path.join(outputDir, shard.name), 'wb'))
+            AddressOuts.append(csv.writer(files[-1], quoting=csv.QUOTE_ALL))
+            AddressOuts[-1].writerow(ADDRESS_HDR)
+        
+        builder = AddressBuilder(static_hdr)
+        
+        for chunk in iterChunks(iterSequenced(records_dict, static_hdr, progress), 
+                                ADDRESS_CHUNK_SIZE):
+            # Write address and Static Data
+            for shard_no, records in iterShardPieces(chunk, starts, seq_idx):
+                AddressOuts[shard_no].writerows(builder.addressRows(records))
+            StaticOut.writerows(chunk)
+    finally:
+        StaticOut.close()
+        for a in files:
+            a.close()
+    if shards:
+        writeShardManifest(outputDir, prefix, plan, shards)
+
+
+def planShards(records_dict, shards=None, prefix=""):
+    """ The Shards AddressData is written to. Without shards it 
+    is the one AddressData.csv. Otherwise shards files of about 
+    the same size, or with "type" one per AddressType, each 
+    a run of consecutive Sequence numbers. An empty shard has 
+    the first_sequence of the next one. """
+    
+    if not shards:
+        total = sum(len(category_records) for category_records in records_dict.values())
+        return [Shard(prefix + "AddressData.csv", None, 1, total)]
+    if shards == "type":
+        sizes = [(category, category, len(records_dict[category])) 
+                 for category in MAILING_ORDER]
+    else:
+        total = sum(len(category_records) for category_records in records_dict.values())
+        sizes = [("{:03d}".format(n + 1), None, total // shards + (n < total % shards)) 
+                 for n in xrange(shards)]
+    
+    plan = []
+    first_sequence = 1
+    for label, category, rows in sizes:
+        plan.append(Shard(prefix + SHARD_FILE.format(label), category, first_sequence, rows))
+        first_sequence += rows
+    return plan
+
+
+def iterShardPieces(chunk, starts, seq_idx):
+    """ Split a chunk of sequenced records into (shard number, 
+    records) runs, the shards starting at the starts Sequences. 
+    The Sequences of a chunk are consecutive, so each run is 
+    sliced off in one go. """
+    i = 0
+    while i < len(chunk):
+        seq = chunk[i][seq_idx]
+        shard_no = bisect.bisect_right(starts, seq) - 1
+        if shard_no + 1 < len(starts):
+            end = i + starts[shard_no + 1] - seq
+        else:
+            end = len(chunk)
+        yield shard_no, chunk[i:end]
+        i = end
+
+
+def writeShardManifest(outputDir, prefix, plan, shards):
+    """ Write AddressData_MANIFEST.json: the name, category, 
+    Sequence range, row count, size and SHA-256 of each shard 
+    in order. Rows do not count the header each shard starts 
+    with. The range of an empty shard is null. """
     
+    entries = []
+    for shard in plan:
+        path = os.path.join(outputDir, shard.name)
+        entries.append(collections.OrderedDict([
+            ("name", shard.name), ("category", shard.category),
+            ("first_sequence", shard.first_sequence if shard.rows else None),
+            ("last_sequence", shard.first_sequence + shard.rows - 1 if shard.rows else None),
+            ("rows", shard.rows), ("bytes", os.path.getsize(path)), 
+            ("sha256", fileDigest(path))]))
+    manifest = collections.OrderedDict([
+        ("sharded_by", "type" if shards == "type" else "count"),
+        ("rows", sum(shard.rows for shard in plan)), ("shards", entries)])
+    with open(os.path.join(outputDir, prefix + SHARD_MANIFEST), 'wb') as m:
+        json.dump(manifest, m, indent=2)
+
 
-def writeRecordsToXLS(outputDir, filename_noext, records_dict, static_hdr) :                        
-    wb = openpyxl.Workbook()
-    ws = wb.create_sheet("Records", 0)
-    ws.append(static_hdr)
+def iterSequenced(records_dict, static_hdr, progress=None):
+    """ The records in mailing order with the Sequence set. 
+    progress is called every WRITER_CHUNK_SIZE records. """
+    seq_idx = static_hdr.index("Sequence")
+    for seq, line in enumerate(iterAllRecords(records_dict), start=1):
+        line[seq_idx] = seq
+        if progress and seq % WRITER_CHUNK_SIZE == 0:
+            progress()
+        yield line
+
+
+def writeRecordsToXLS(outputDir, filename_noext, records_dict, static_hdr, 
+                      max_rows=XLS_MAX_ROWS, split_files=False, progress=None):
+    """ Write the records to the _rev.xlsx workbook, see 
+    writeWorkbook, progress being as for iterSequenced. Return 
+    the list of workbooks written. """
+    return writeWorkbook(outputDir, filename_noext, 
+                         iterSequenced(records_dict, static_hdr, progress), 
+                         static_hdr, max_rows, split_files)
     
-    # Combine records into single list
-    all_records = []
-    for category in ["MEX", "CAN", "FGN", "DOM"]:
-        all_records.extend(records_dict[category])
 
-    for seq, row in enumerate(all_records, start=1):
-        row[static_hdr.index("Sequence")] = seq
+def writeWorkbook(outputDir, filename_noext, records, static_hdr, 
+                  max_rows=XLS_MAX_ROWS, split_files=False):
+    """ Stream the sequenced records into a write only workbook. 
+    When a sheet reaches max_rows records, continue on a new 
+    sheet, or in a new _rev_N.xlsx file when split_files is 
+    set. Return the list of workbooks written. Without lxml 
+    openpyxl holds each sheet in memory until it is saved. """
+    
+    import openpyxl
+    if not openpyxl.LXML:
+        print "lxml is not installed, so the _rev.xlsx is built in memory.", 
+        print "For large files install lxml, or use --no-xlsx or --xlsx-split-files.\n"
+    outExcel = os.path.join(outputDir, "{}_rev.xlsx".format(filename_noext))
+    excelFiles = [outExcel]
+    
+    wb = openpyxl.Workbook(write_only=True)
+    ws = None
+    sheet_no = 0
+    sheet_rows = 0
+    
+    for row in staticRows(records, static_hdr):
+        if ws is None or sheet_rows >= max_rows:
+            if ws is not None and split_files:
+                wb.save(outExcel)
+                outExcel = os.path.join(outputDir, "{}_rev_{}.xlsx".format(
+                    filename_noext, len(excelFiles) + 1))
+                excelFiles.append(outExcel)
+                wb = openpyxl.Workbook(write_only=True)
+                sheet_no = 0
+            sheet_no += 1
+            ws = wb.create_sheet(xlsSheetName(sheet_no))
+            ws.append(static_hdr)
+            sheet_rows = 0
+            
         ws.append(row)
+        sheet_rows += 1
+    
+    # Header only workbook when there are no records
+    if ws is None:
+        ws = wb.create_sheet(xlsSheetName(1))
+        ws.append(static_hdr)
     
     # Save work book
-    outExcel = os.path.join(outputDir, "{}_rev.xlsx".format(filename_noext))
     wb.save(outExcel)
+    return excelFiles
+
+
+def writeOutputs(outputDir, filename_noext, records_dict, static_hdr, prefix="", xlsx=True, 
+                 static_format="csv", shards=None, max_rows=XLS_MAX_ROWS, split_files=False, 
+                 progress=None):
+    """ Write AddressData.csv, the Static Data and, with xlsx, 
+    the _rev.xlsx workbook at the same time, max_rows and 
+    split_files being as for writeWorkbook and progress as for 
+    iterSequenced. One pass sets the Sequence and hands each 
+    chunk of records to a writer process per output through a 
+    bounded queue, so the writers run side by side and the 
+    total is about that of the slowest one. With 
+    shards each AddressData shard has its own writer, which gets 
+    only the records of its shard. """
+    
+    plan = planShards(records_dict, shards, prefix)
+    starts = [shard.first_sequence for shard in plan]
+    seq_idx = static_hdr.index("Sequence")
+    writers = [(shard.name, writeAddressData, shard.name, ()) for shard in plan]
+    writers.append((STATIC_FORMATS[static_format], writeStaticData, prefix, (static_format,)))
+    if xlsx:
+        writers.append(("_rev.xlsx", writeWorkbook, filename_noext, (max_rows, split_files)))
+    
+    processes = []
+    try:
+        for name, writer, writer_name, writer_args in writers:
+            queue = multiprocessing.Queue(WRITER_QUEUE_CHUNKS)
+            process = multiprocessing.Process(target=runWriter, 
+                args=(writer, outputDir, writer_name, queue, static_hdr) + writer_args)
+            process.start()
+            processes.append((name, process, queue))
+        
+        address_writers = processes[:len(plan)]
+        records = iterSequenced(records_dict, static_hdr, progress)
+        while True:
+            chunk = list(itertools.islice(records, WRITER_CHUNK_SIZE))
+            # Pickled once here rather than once per queue
+            data = cPickle.dumps(chunk, cPickle.HIGHEST_PROTOCOL)
+            for name, process, queue in processes[len(plan):]:
+                putChunk(queue, data, name, process)
+            if not chunk:
+                for name, process, queue in address_writers:
+                    putChunk(queue, data, name, process)
+                break
+            for shard_no, shard_records in iterShardPieces(chunk, starts, seq_idx):
+                name, process, queue = address_writers[shard_no]
+                putChunk(queue, data if len(shard_records) == len(chunk) else 
+                         cPickle.dumps(shard_records, cPickle.HIGHEST_PROTOCOL), name, process)
+        
+        for name, process, queue in processes:
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError("The {} writer failed".format(name))
+    finally:
+        for name, process, queue in processes:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+    if shards:
+        writeShardManifest(outputDir, prefix, plan, shards)
+
+
+def putChunk(queue, data, name, process):
+    """ Wait for room in the writer's queue, unless it died. """
+    while True:
+        try:
+            queue.put(data, timeout=1)
+            return
+        except Queue.Full:
+            if not process.is_alive():
+                raise RuntimeError("The {} writer failed".format(name))
+
+
+def runWriter(writer, outputDir, name, queue, static_hdr, *writer_args):
+    """ Writer process of writeOutputs. """
+    writer(outputDir, name, iterQueue(queue), static_hdr, *writer_args)
+
+
+def iterQueue(queue):
+    """ The records of the chunks read from the queue, up to 
+    the empty chunk that ends them. """
+    while True:
+        chunk = cPickle.loads(queue.get())
+        if not chunk:
+            return
+        for record in chunk:
+            yield record
+
+
+def writeAddressData(outputDir, filename, records, static_hdr):
+    with open(os.path.join(outputDir, filename), 'wb') as a:
+        AddressOut = csv.writer(a, quoting=csv.QUOTE_ALL)
+        AddressOut.writerow(ADDRESS_HDR)
+        builder = AddressBuilder(static_hdr)
+        for chunk in iterChunks(records, ADDRESS_CHUNK_SIZE):
+            AddressOut.writerows(builder.addressRows(chunk))
+
+
+def writeStaticData(outputDir, prefix, records, static_hdr, static_format="csv"):
+    StaticOut = openStaticData(outputDir, prefix, static_hdr, static_format)
+    try:
+        StaticOut.writerows(records)
+    finally:
+        StaticOut.close()
+
+
+def openStaticData(outputDir, prefix, static_hdr, static_format="csv"):
+    """ A writer for the Static Data in one of STATIC_FORMATS, 
+    with the header written. Records are added with writerows 
+    and the file is finished by close. """
+    path = os.path.join(outputDir, prefix + STATIC_FORMATS[static_format])
+    if static_format == "columns":
+        return StaticColumnWriter(path, static_hdr)
+    return StaticCSVWriter(path, static_hdr, static_format)
+
+
+class StaticCSVWriter(object):
+    """ StaticData.dat, plain or compressed as it is written. 
+    Compressed rows are formatted a chunk at a time, so the 
+    compressor gets a few large writes instead of one a row. """
+    
+    def __init__(self, path, static_hdr, static_format="csv"):
+        self.file = open(path, 'wb')
+        if static_format == "gzip":
+            # No file name or time in the header, the same records give the same file
+            self.stream = gzip.GzipFile("", 'wb', GZIP_LEVEL, self.file, mtime=0)
+        elif static_format == "zstd":
+            import zstandard
+            self.stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(self.file)
+        else:
+            self.stream = None
+        self.buffer = cStringIO.StringIO() if self.stream else self.file
+        self.out = csv.writer(self.buffer, quoting=csv.QUOTE_ALL)
+        self.static_hdr = static_hdr
+        self.writerows([static_hdr])
+        
+    def writerows(self, rows):
+        rows = staticRows(rows, self.static_hdr)
+        if not self.stream:
+            self.out.writerows(rows)
+            return
+        for chunk in iterChunks(rows, WRITER_CHUNK_SIZE):
+            self.out.writerows(chunk)
+            self.stream.write(self.buffer.getvalue())
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        
+    def close(self):
+        if self.stream:
+            self.stream.close()
+        self.file.close()
+
+
+class StaticColumnWriter(object):
+    """ The Static Data as a column file: COLUMN_MAGIC, the 
+    marshalled header, then a marshalled (rows, columns) pair 
+    for each COLUMN_GROUP_ROWS records. Each column is the zlib 
+    compressed, marshalled list of its values, so a reader only 
+    decompresses the fields it needs. Values keep their type: 
+    Sequence is an int, the rest are strings. """
+    
+    def __init__(self, path, static_hdr):
+        self.file = open(path, 'wb')
+        self.file.write(COLUMN_MAGIC)
+        marshal.dump(list(static_hdr), self.file)
+        self.static_hdr = static_hdr
+        self.group = []
+        
+    def writerows(self, rows):
+        rows = staticRows(rows, self.static_hdr)
+        while True:
+            self.group.extend(itertools.islice(rows, COLUMN_GROUP_ROWS - len(self.group)))
+            if len(self.group) < COLUMN_GROUP_ROWS:
+                return
+            self.flush()
+            
+    def flush(self):
+        if self.group:
+            columns = [zlib.compress(marshal.dumps(list(values)), COLUMN_LEVEL) 
+                       for values in itertools.izip(*self.group)]
+            marshal.dump((len(self.group), columns), self.file)
+            self.group = []
+        
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def iterStaticData(path, fields=None):
+    """ Read back Static Data in any of STATIC_FORMATS, told 
+    apart by the file name. Yield the header, then each record, 
+    as lists. With fields, only those fields are yielded, and 
+    only their columns are decompressed from a column file. """
+    
+    if path.endswith(".cols"):
+        for row in iterStaticColumns(path, fields):
+            yield row
+        return
+    
+    if path.endswith(".gz"):
+        stream = io.BufferedReader(gzip.GzipFile(path, 'rb'))
+    elif path.endswith(".zst"):
+        import zstandard
+        stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+    else:
+        stream = open(path, 'rb')
+    with stream:
+        reader = csv.reader(stream)
+        header = next(reader)
+        if fields is None:
+            yield header
+            for row in reader:
+                yield row
+        else:
+            pick = operator.itemgetter(*[header.index(field) for field in fields])
+            yield list(fields)
+            for row in reader:
+                yield list(pick(row)) if len(fields) > 1 else [pick(row)]
+
+
+def iterStaticColumns(path, fields=None):
+    with open(path, 'rb') as c:
+        if c.read(len(COLUMN_MAGIC)) != COLUMN_MAGIC:
+            raise ValueError("{} is not a Static Data column file".format(path))
+        header = marshal.load(c)
+        idxs = range(len(header)) if fields is None else [header.index(f) for f in fields]
+        yield [header[i] for i in idxs]
+        while True:
+            try:
+                rows, columns = marshal.load(c)
+            except EOFError:
+                return
+            values = [marshal.loads(zlib.decompress(columns[i])) for i in idxs]
+            for row in itertools.izip(*values):
+                yield list(row)
+    
+
+def writeMalformed(outputDir, prefix, rejects):
+    """ Write the malformed TXT lines as they were in the 
+    input, so they can be fixed and sent again. """
+    
+    path = os.path.join(outputDir, prefix + MALFORMED_FILE)
+    with open(path, 'wb') as m:
+        for offset, line in rejects:
+            m.write(line)
+    print "Wrote {} malformed records to {}\n".format(len(rejects), path)
+
+
+def xlsSheetName(sheet_no):
+    return "Records" if sheet_no == 1 else "Records {}".format(sheet_no)
     
     
-def writeCountsToTXT(outputDir, filename, records_dict):                        
+def writeCountsToTXT(outputDir, filename, records_dict, prefix="", malformed=0):
     ''' Get counts for reporting. Print to screen 
-    and write to text file. '''
+    and write to text file. Malformed lines are 
+    counted only if there were any. '''
     
     domesticCount = len(records_dict["DOM"])
     mexicoCount = len(records_dict["MEX"])
@@ -575,10 +2873,82 @@ def writeCountsToTXT(outputDir, filename, records_dict):
      "Canada count: {}".format(canadaCount),
      "Other count: {}".format(otherCount),
     ])
+    if malformed:
+        countsReport += "\r\n\r\nMalformed records: {} (see {})".format(
+            malformed, prefix + MALFORMED_FILE)
     
     print countsReport
-    with open(os.path.join(outputDir, "COUNTS.txt"),'wb') as c:
+    with open(os.path.join(outputDir, prefix + "COUNTS.txt"),'wb') as c:
         c.write(countsReport)
+
+
+class RunMetrics(object):
+    """ Wall time, CPU time, records/sec and peak RSS of each 
+    pipeline stage, in the order the stages were added. Peak 
+    RSS is the high-water mark of the process at the end of 
+    the stage. CPU time includes child processes, such as the 
+    --workers pool and the writers, once they have exited. """
+    
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        
+    def add(self, name, wall_seconds, cpu_seconds, records):
+        self.stages[name] = collections.OrderedDict([
+            ("wall_seconds", round(wall_seconds, 4)),
+            ("cpu_seconds", round(cpu_seconds, 4)),
+            ("records", records),
+            ("records_per_sec", round(records / wall_seconds, 1) if wall_seconds > 0 else 0.0),
+            ("peak_rss_mb", peakRSS())])
+        
+    def measure(self, name, records, func, *args):
+        """ Add the stage func(*args) and return its result. """
+        start, cpu_start = time.time(), cpuTime()
+        result = func(*args)
+        self.add(name, time.time() - start, cpuTime() - cpu_start, records)
+        return result
+        
+    def iterTimed(self, name, records):
+        """ Yield the records, timing only the time spent getting 
+        them. Records are fetched METRICS_CHUNK_SIZE at a time so 
+        the clocks are not read for every record. The stage is 
+        added when the records run out. """
+        wall_seconds = cpu_seconds = 0.0
+        count = 0
+        records = iter(records)
+        while True:
+            start, cpu_start = time.time(), cpuTime()
+            chunk = list(itertools.islice(records, METRICS_CHUNK_SIZE))
+            wall_seconds += time.time() - start
+            cpu_seconds += cpuTime() - cpu_start
+            if not chunk:
+                break
+            count += len(chunk)
+            for record in chunk:
+                yield record
+        self.add(name, wall_seconds, cpu_seconds, count)
+
+
+def cpuTime():
+    """ User plus system CPU seconds of this process and its 
+    exited child processes. """
+    return sum(os.times()[:4])
+
+
+def peakRSS():
+    """ Peak resident set size of this process in MB, or None 
+    where the resource module is missing (Windows). """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return round(peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0, 1)
+
+
+def writeMetricsToJSON(outputDir, filename, metrics, prefix=""):
+    """ Write the stage metrics of the run to METRICS.json. """
+    report = collections.OrderedDict([("filename", filename), ("stages", metrics.stages)])
+    with open(os.path.join(outputDir, prefix + "METRICS.json"), 'wb') as m:
+        json.dump(report, m, indent=2)
    
     
 if __name__ == "__main__":
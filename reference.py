@@ -0,0 +1,292 @@
+'''
+Reference
+
+The record handling of parse.py as of January 28, 2018, before
+the speedups: replaceNonAsciiChars, processTXT, createRecordsDict,
+sortForeignByCountry and createMMAddress, with the writers of
+AddressData.csv, StaticData.dat and COUNTS.txt. Nothing here
+comes from parse.py. golden.py diffs the current code paths
+against these outputs and benchmark.py times them as the legacy
+baseline. Only the TXT layout of that version is read.
+'''
+
+import os
+import csv
+import re
+import struct
+
+STATIC_HDR = ["FileTransmissionDate", "UPRR Job Number", "LT", "Company Name", 
+              "Company Number", "ASTSourceFileDate", "Account Number", 
+              "NameAddress1", "NameAddress2", "NameAddress3", "NameAddress4", 
+              "NameAddress5", "NameAddress6", "NameAddress7", "NameAddress8", 
+              "Verification Code", "Filler", "Mailing City", "Zip", "Mailing State", 
+              "Shares", "Certified", "LetterCode", "Sequence", "Escheatment State", 
+              "AddressType"]
+
+TXT_FORMAT = "8s 6s 9s 40s 12s 8s 19s 40s 40s 40s 40s 40s 40s 40s 4s 36s 40s 9s 2s 14s 1s 2s 6s 20s"
+TXT_STRUCT = struct.Struct(TXT_FORMAT)
+
+ADDRESS_HDR = ["IM barcode Digits", "OEL", "Sack and Pack Numbers",
+               "Presort Sequence", "Full Name", "Name2", "Name3", 
+               "Name4","Name5","Name6","Name7","Name8","Delivery Address",
+               "Alternate 1 Address","City","State","ZIP+4","LTNo","SEQ"]
+
+CANADA_PLACES = "\\b" + "\\b|\\b".join(["Canada","Alberta","Calgary","Edmonton",
+"Strathcona County","British Columbia","Vancouver","Surrey","Burnaby","Manitoba",
+"Winnipeg","Brandon","Springfield","New Brunswick","Moncton","Saint John","Fredericton",
+"Newfoundland and Labrador","St. John's","Conception Bay South","Mount Pearl",
+"Northwest Territories","Yellowknife","Hay River","Inuvik","Nova Scotia",
+"Halifax","Sydney","Lunenburg","Nunavut","Iqaluit","Arviat","Rankin Inlet",
+"Ontario","Toronto","Ottawa","Mississauga","Prince Edward Island","Charlottetown",
+"Summerside","Stratford","Quebec","Montreal","Quebec City","Laval","Saskatchewan",
+"Saskatoon","Regina","Prince Albert","Yukon","Whitehorse","Dawson City","Faro"]) + "\\b"
+
+MEXICO_PLACES = "\\b" + "\\b|\\b".join(["Chihuahua","Sonora","Coahuila",
+"Durango","Oaxaca","Tamaulipas","Jalisco","Zacatecas","Baja California Sur",
+"Chiapas","Veracruz","Baja California","Nuevo Leon","Guerrero","San Luis Potosi",
+"Michoacan","Sinaloa","Campeche","Quintana Roo","Yucatan","Puebla","Guanajuato",
+"Nayarit","Tabasco","Mexico","Hidalgo","Queretaro","Colima","Aguascalientes",
+"Morelos","Tlaxcala","Ciudad de Mexico","Mexico City","Ecatepec","Guadalajara",
+"Puebla","Juarez","Tijuana","Leon","Monterrey","Zapopan","Nezahualcoyotl","Culiacan",
+"Chihuahua","Naucalpan","Merida","San Luis Potosi","Aguascalientes","Hermosillo",
+"Saltillo","Mexicali","Guadalupe","Acapulco","Tlalnepantla","Cancun","Queretaro",
+"Chimalhuacan","Torreon","Morelia","Reynosa","Tlaquepaque","Tuxtla Gutierrez",
+"Durango","Toluca","Ciudad Lopez Mateos","Cuautitlan Izcalli","Ciudad Apodaca","Matamoros",
+"San Nicolas de los Garza","Veracruz","Xalapa","Tonala","Mazatlan","Irapuato",
+"Nuevo Laredo","Xico","Villahermosa","General Escobedo","Celaya","Cuernavaca","Tepic",
+"Ixtapaluca","Ciudad Victoria","Ciudad Obregon","Tampico","Ciudad Nicolas Romero",
+"Ensenada","Coacalco de Berriozabal","Santa Catarina","Uruapan","Gomez Palacio",
+"Los Mochis","Pachuca","Oaxaca","Soledad de Graciano Sanchez","Tehuacan","Ojo de Agua",
+"Coatzacoalcos","Campeche","Monclova","La Paz","Nogales","Buenavista","Puerto Vallarta",
+"Tapachula","Ciudad Madero","San Pablo de las Salinas","Chilpancingo","Poza Rica",
+"Chicoloapan de Juarez","Ciudad del Carmen","Chalco de Diaz Covarrubias","Jiutepec",
+"Salamanca","San Luis Rio Colorado","Cuautla","Ciudad Benito Juarez","Chetumal",
+"Piedras Negras","Playa del Carmen","Zamora","Cordoba","San Juan del Rio","Colima",
+"Ciudad Acuna","Manzanillo","Zacatecas","Veracruz","Ciudad Valles","Guadalupe",
+"San Pedro Garza Garcia","Naucalpan","Fresnillo","Orizaba","Miramar","Iguala",
+"Delicias","Ciudad de Villa de alvarez","Ciudad Cuauhtemoc","Navojoa","Guaymas",
+"Minatitlan","Cuautitlan","Texcoco","Hidalgo del Parral","Tepexpan","Tulancingo"]) + "\\b"
+
+CANADA_ZIP_PATTERN = re.compile(r'\b[ABCEGHJ-NPRSTVXY][0-9][ABCEGHJ-NPRSTV-Z](\s|-)?[0-9][ABCEGHJ-NPRSTV-Z][0-9]\b', flags=re.IGNORECASE)
+CANADA_PROV_PATTERN = re.compile(CANADA_PLACES, flags=re.IGNORECASE)
+CANADA_MAJOR_CITIES_PATTERN = re.compile(r'\bCANADA\b|\bTORONTO\b|\bONTARIO\b|\bQUEBEC\b|\bALBERTA\b|\bMONTREAL\b', flags=re.IGNORECASE)
+ONTARIO_QUEBEC_ABBV_PATTERN = re.compile(r'(\bON\b)|(\bQC\b)\s\b[ABCEGHJ-NPRSTVXY][0-9][ABCEGHJ-NPRSTV-Z]', flags=re.IGNORECASE)
+MEXICO_PATTERN = re.compile(MEXICO_PLACES, flags=re.IGNORECASE)
+
+
+def replaceNonAsciiChars(text):
+    """ Convert byte text to unicode chars. Replace non-ASCII,
+    the "replacement", "non-breaking space" and "Broken Bar" 
+    chars. Convert chars back into bytes. """
+    
+    char_text = text.decode("utf-8", errors='replace').replace(u'\ufffd', " ")
+    replace_nbspace = char_text.replace(u'\u00A6', " ")
+    replace_bknbar = replace_nbspace.replace(u'\u00A0', " ")
+    latin_text = replace_bknbar.encode("latin-1")
+    ascii_char = latin_text.decode("ascii", errors='replace').replace(u'\ufffd', " ")
+    byte_text = ascii_char.encode("ascii")
+    return byte_text
+
+
+def processTXT(inFile, static_hdr):
+    """ Split each line into fields with parseTXTLine. """
+    
+    recordsList = []
+    with open(inFile, 'rb') as o:
+        for line in o:
+            recordsList.append(parseTXTLine(line, static_hdr))
+    return recordsList
+
+
+def parseTXTLine(line, static_hdr):
+    """ Remove extra spaces in fields. Add blanks for 
+    AddrLine8 and AddressType. """
+    ascii_line = replaceNonAsciiChars(line)
+    outputLine = [" ".join(x.split()) for x in TXT_STRUCT.unpack_from(ascii_line)]
+    outputLine.insert(static_hdr.index("NameAddress7"), "")
+    outputLine.append("")
+    return outputLine
+
+
+def createRecordsDict(recordsList, static_hdr, letterCode):    
+    """ Sort Record List into mailing categories. 
+    Fix Zip for domestic addresses as needed. """
+    
+    records_dict = {"MEX" : [], "CAN" : [],
+                    "FGN" : [], "DOM" : []}
+    
+    foreignData = []
+    
+    for dataRow in recordsList:
+        # Add the Letter Code to the record.     
+        dataRow[static_hdr.index("LetterCode")] = letterCode
+        
+        if dataRow[static_hdr.index("Mailing State")] == "FO":
+            dataRow[static_hdr.index("Zip")] = ""
+            foreignData.append(dataRow)
+        else:
+            zip = dataRow[static_hdr.index("Zip")]
+            if len(zip) > 5 and "-" not in zip:
+                zip = "{}-{}".format(zip[:5], zip[5:])
+            dataRow[static_hdr.index("Zip")] = zip
+            dataRow[static_hdr.index("AddressType")] = "DOM"
+            records_dict["DOM"].append(dataRow)
+    
+    sortForeignByCountry(foreignData, records_dict, static_hdr)
+    
+    return records_dict
+
+
+def sortForeignByCountry(foreignData, records_dict, static_hdr):
+    """ Sort foreign data into Mexico, Canada and  
+    other foreign countries by reviewing the mailing 
+    city and last of the address lines. """
+    
+    city_idx = static_hdr.index("Mailing City")
+    addr_start = static_hdr.index("NameAddress1")
+    addr_end = static_hdr.index("NameAddress8")+1
+    
+    # Sort by countries
+    sorted_foreign = sorted(foreignData, key=lambda row: row[city_idx]) 
+    
+    # Sort to Canada, Mexico and Other Foreign
+    for record in sorted_foreign:
+        addrfields = [f for f in record[addr_start:addr_end] if f.upper() not in ["","NULL"]]
+        last_addr_field = addrfields[-1]
+        record_city = record[city_idx]
+        
+        category = classify(record_city, last_addr_field)
+        record[static_hdr.index("AddressType")] = category
+        records_dict[category].append(record)
+
+
+def classify(record_city, last_addr_field):
+    """ Check for country pattern and check that 
+    it is not another country that has similar names """
+    if (re.search(CANADA_ZIP_PATTERN, record_city) or \
+    re.search(ONTARIO_QUEBEC_ABBV_PATTERN, record_city) or \
+    re.search(CANADA_MAJOR_CITIES_PATTERN, last_addr_field) or \
+    re.search(CANADA_PROV_PATTERN, record_city)) and not\
+    (re.search(r'\bLONDON\b|\bUK\b|\bUNIT\b|\bGBR\b|\bAUS(TRALIA)?\b', record_city, flags=re.IGNORECASE)):
+        return "CAN"
+    elif (re.search(MEXICO_PATTERN, record_city)) and not \
+    (re.search(r'\bSPAIN\b|\bESPANA\b|\bITALY\b', record_city, flags=re.IGNORECASE)):
+        return "MEX"
+    return "FGN"
+
+
+def createMMAddress(line, static_hdr):
+    """ Extract needed fields from the static data to create 
+    the BCC data. Move last line of the Name/Address fields 
+    to the Delivery or Alternate Address position. """
+    
+    ''' Create new line from data '''
+    mmfields = [
+        line[static_hdr.index("NameAddress1")],
+        line[static_hdr.index("NameAddress2")],
+        line[static_hdr.index("NameAddress3")],
+        line[static_hdr.index("NameAddress4")],
+        line[static_hdr.index("NameAddress5")],
+        line[static_hdr.index("NameAddress6")],
+        line[static_hdr.index("NameAddress7")],
+        line[static_hdr.index("NameAddress8")],
+        line[static_hdr.index("Mailing City")],
+        line[static_hdr.index("Mailing State")],
+        line[static_hdr.index("Zip")]
+        ] 
+        
+    namesAndStreet = mmfields[:8]
+    namesAndStreet_NoBlanks = [f for f in namesAndStreet if f.upper() not in ["","NULL"]]
+    city = mmfields[8]
+    cityStateZip = mmfields[8:]
+
+    ''' Find last line of name/address lines 
+    and move Delivery/Alternate Addr position '''
+    if line[static_hdr.index("AddressType")] in ["MEX","CAN","FGN"]:
+        return formatForeignAddress(namesAndStreet_NoBlanks, city)   
+    else:    
+        return formatDomesticAddress(namesAndStreet_NoBlanks, cityStateZip)
+        
+
+def formatForeignAddress(namesAndStreet_NoBlanks, city):
+    namesAndStreet_NoBlanks.append(city)
+    spaceShift = [""] * (8-len(namesAndStreet_NoBlanks))
+    deliveryAddr = ""
+    alternateAddr = ""
+    cityStateZip = ["","",""]
+    
+    return namesAndStreet_NoBlanks + spaceShift + [deliveryAddr, alternateAddr] + cityStateZip
+        
+        
+def formatDomesticAddress(namesAndStreet_NoBlanks, cityStateZip):        
+    
+    if len(namesAndStreet_NoBlanks) < 2:
+        spaceShift = [""] * (8-len(namesAndStreet_NoBlanks))
+        deliveryAddr = ""
+        alternateAddr = ""
+        return namesAndStreet_NoBlanks + spaceShift + [deliveryAddr, alternateAddr] + cityStateZip
+    else:
+        apt_pattern = re.compile(r'^((#|B(UI)?LD(IN)?G|SUITE|LOT|UNIT|FLOOR|R(OO)?M|AP(ARTMEN)?T).+|(\d{1,4}\s?\w)|(\d{1,3}(ST|ND|RD|TH)?\s?FL(OO)?R?))$', flags=re.IGNORECASE)
+        deliveryAddr = namesAndStreet_NoBlanks[-1]
+        
+        addrIdx = -2 if apt_pattern.match(deliveryAddr) and len(namesAndStreet_NoBlanks) > 2 else -1
+        alternateAddr = namesAndStreet_NoBlanks[-1] if apt_pattern.match(deliveryAddr) and len(namesAndStreet_NoBlanks) > 2 else ""
+        nameLines = namesAndStreet_NoBlanks[:addrIdx]
+        spacesShift = [""] * (8 - len(nameLines))
+        deliveryAddr = namesAndStreet_NoBlanks[addrIdx]
+
+        return nameLines + spacesShift + [deliveryAddr, alternateAddr] + cityStateZip
+
+
+def writeRecordsToCSV(outputDir, records_dict, static_hdr):                        
+    with open(os.path.join(outputDir, "AddressData.csv"), 'wb') as a:
+        with open(os.path.join(outputDir, "StaticData.dat"), 'wb') as s:
+                
+                AddressOut = csv.writer(a, quoting=csv.QUOTE_ALL)
+                AddressOut.writerow(ADDRESS_HDR)
+                
+                StaticOut = csv.writer(s, quoting=csv.QUOTE_ALL)
+                StaticOut.writerow(static_hdr)
+                
+                # Combine records into single list
+                all_records = []
+                for category in ["MEX", "CAN", "FGN", "DOM"]:
+                    all_records.extend(records_dict[category])
+                
+                for seq, line in enumerate(all_records, start=1):
+                    line[static_hdr.index("Sequence")] = seq
+
+                    # Write address and Static Data
+                    LTNo = line[static_hdr.index("LT")]
+                    mmAddress = createMMAddress(line, static_hdr)                            
+                    AddressOut.writerow(["", "", "", seq] + mmAddress + [LTNo] + [seq])
+                    
+                    StaticOut.writerow(line)
+
+
+def countsReport(filename, records_dict):
+    ''' Get counts for reporting. '''
+    
+    domesticCount = len(records_dict["DOM"])
+    mexicoCount = len(records_dict["MEX"])
+    canadaCount = len(records_dict["CAN"])
+    otherCount = len(records_dict["FGN"])
+    foreignCount = mexicoCount + canadaCount + otherCount
+    totalCount = domesticCount + foreignCount
+    
+    return "\r\n".join(
+    ["Filename: {}".format(filename),
+     "Domestic count: {}".format(domesticCount),
+     "Foreign count: {}".format(foreignCount),
+     "Total Records: {}".format(totalCount),
+     "",
+     "Mexico count: {}".format(mexicoCount),
+     "Canada count: {}".format(canadaCount),
+     "Other count: {}".format(otherCount),
+    ])
+
+
+def writeCountsToTXT(outputDir, filename, records_dict):                        
+    ''' Write the counts to a text file. '''
+    with open(os.path.join(outputDir, "COUNTS.txt"),'wb') as c:
+        c.write(countsReport(filename, records_dict))
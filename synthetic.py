@@ -0,0 +1,268 @@
+'''
+Synthetic
+
+Write synthetic input files for benchmark.py: fixed width TXT
+files in any TXT layout version and XLSX files with the Excel
+headers matched by create_data_fields. Records are a seeded
+mix of domestic, Canadian, Mexican and other foreign addresses
+with some non-ASCII noise, blank LT numbers and NULL lines.
+edge files add the cases the code paths are most likely to
+disagree on, for golden.py.
+
+Usage:
+    python synthetic.py txt <rows> <file.txt> [seed [version]]
+    python synthetic.py edge <rows> <file.txt> [seed]
+    python synthetic.py xlsx <rows> <file.xlsx> [seed]
+'''
+
+import sys
+import random
+import collections
+
+import parse
+
+# Share of DOM, CAN, MEX and FGN records
+CATEGORY_MIX = [("DOM", 0.70), ("CAN", 0.12), ("MEX", 0.08), ("FGN", 0.10)]
+
+# Share of records with a non-ASCII character, a blank LT
+# number and a NULL Name/Address line
+NOISE_RATE = 0.05
+BLANK_LT_RATE = 0.10
+NULL_LINE_RATE = 0.15
+
+DEFAULT_SEED = 20180128
+
+EXCEL_HEADERS = ["XRX Acct Seq", "Issue Name", "Company", "Account",
+                 "Name/Address1", "Name/Address2", "Name/Address3", "Name/Address4",
+                 "Name/Address5", "Name/Address6", "Name/Address7",
+                 "City", "State", "Zip", "Eligible Shares", "Eligibility State"]
+
+US_CITIES = [("DENVER", "CO"), ("OMAHA", "NE"), ("NEW YORK", "NY"), ("CHICAGO", "IL"),
+             ("SAN JUAN", "PR"), ("AUSTIN", "TX"), ("BOISE", "ID"), ("MIAMI", "FL")]
+
+CANADA_CITIES = ["TORONTO ON M5V 2T6", "MONTREAL QC H2X 1Y4", "CALGARY AB", "OTTAWA",
+                 "VANCOUVER BC V6B 1A1", "HALIFAX NOVA SCOTIA", "WINNIPEG MANITOBA"]
+
+MEXICO_CITIES = ["MEXICO CITY", "GUADALAJARA JAL", "MONTERREY NL", "Leon", "Nogales",
+                 "TIJUANA BAJA CALIFORNIA", "Puebla"]
+
+FOREIGN_CITIES = ["LONDON UK", "PARIS", "SYDNEY AUS", "MADRID SPAIN", "BERLIN",
+                  "ROME ITALY", "TOKYO JAPAN", "LONDON ON UNIT 4 GBR"]
+
+FOREIGN_COUNTRIES = {"CAN": ["CANADA", "ONTARIO", ""], "MEX": ["MEXICO", ""],
+                     "FGN": ["UNITED KINGDOM", "FRANCE", "AUSTRALIA", "SPAIN", ""]}
+
+SECOND_LINES = ["APT 1", "SUITE 100", "#5", "UNIT 7", "3RD FLR", "PO BOX 5", ""]
+
+ZIP_FORMATS = ["{:05d}", "{:05d}{:04d}", "{:05d}-{:04d}", "{:04d}"]
+
+# replaceNonAsciiChars raises on characters past Latin-1,
+# as it always has, so the noise stays below U+0100
+NOISE = [u"\u00e9", u"\u00a0", u"\u00a6", u"\u00f1", u"\u00fc", u"\ufffd"]
+
+# Share of edge records given each of the edge cases
+EDGE_CASE_RATE = 0.3
+
+# Earlier records a repeated record is copied from
+REPEAT_WINDOW = 50
+
+NULL_SPELLINGS = [u"NULL", u"null", u"Null", u""]
+
+# Apartment lines and near misses that are street lines
+APT_TAILS = [u"APT 4B", u"Apt 1", u"APARTMENT 12", u"BLDG 3", u"BUILDING 7", u"RM 210",
+             u"ROOM 5", u"FLOOR 2", u"3RD FLR", u"12 FL", u"LOT 44", u"UNIT C", u"# 9",
+             u"#12", u"SUITE 300", u"4B", u"12A", u"APTOS CA", u"ROOMS TO GO"]
+
+NINE_DIGIT_ZIPS = [u"{:05d}{:04d}", u"{:05d}-{:04d}", u"{:05d} {:04d}"]
+
+# Single Latin-1 bytes, not UTF-8 encoded. Each is one
+# invalid byte, so it cleans to one space like a character.
+RAW_BYTES = ["\xe9", "\xa0", "\xa6", "\xff", "\x80", "\xc3"]
+
+
+def syntheticRecords(rows, seed=DEFAULT_SEED):
+    """ Yield rows records as dicts of unicode values keyed by
+    the static_hdr field names. The same seed gives the same
+    records. """
+
+    rand = random.Random(seed)
+    us_states = sorted(parse.create_us_dict().items())
+    categories = [c for c, share in CATEGORY_MIX]
+    weights = [share for c, share in CATEGORY_MIX]
+
+    for row in xrange(rows):
+        category = pickWeighted(rand, categories, weights)
+
+        names = [u"{} {} {}".format(rand.choice([u"JOHN", u"MARY", u"JOSE", u"ANNE"]),
+                                    rand.choice([u"Q", u"", u"B"]),
+                                    rand.choice([u"DOE", u"SMITH", u"GARCIA", u"TREMBLAY"])),
+                 rand.choice([u"", u"C/O FIRST BANK", u"JT TEN"])]
+        if rand.random() < NULL_LINE_RATE:
+            names[1] = u"NULL"
+        street = [u"{} MAIN ST".format(rand.randint(1, 9999)),
+                  unicode(rand.choice(SECOND_LINES))]
+
+        if category == "DOM":
+            city, state = rand.choice(US_CITIES)
+            zipcode = rand.choice(ZIP_FORMATS).format(rand.randint(0, 99999),
+                                                      rand.randint(0, 9999))
+            lines = names + street
+        else:
+            city = {"CAN": rand.choice(CANADA_CITIES), "MEX": rand.choice(MEXICO_CITIES),
+                    "FGN": rand.choice(FOREIGN_CITIES)}[category]
+            state = "FO"
+            zipcode = ""
+            lines = names + street + [unicode(rand.choice(FOREIGN_COUNTRIES[category]))]
+
+        if rand.random() < NOISE_RATE:
+            pos = rand.randint(0, len(lines[0]))
+            lines[0] = lines[0][:pos] + rand.choice(NOISE) + lines[0][pos:]
+
+        escheat_abbv, escheat_name = rand.choice(us_states)
+        record = {"FileTransmissionDate": u"20180128", "UPRR Job Number": u"JOB001",
+                  "LT": u"" if rand.random() < BLANK_LT_RATE else u"{:09d}".format(row),
+                  "Company Name": u"ACME  HOLDINGS CORP",
+                  "Company Number": u"{}".format(rand.randint(1, 40)),
+                  "ASTSourceFileDate": u"20180101", "Account Number": u"A{:08d}".format(row),
+                  "Verification Code": u"{:04d}".format(rand.randint(0, 9999)), "Filler": u"",
+                  "Mailing City": unicode(city), "Zip": unicode(zipcode),
+                  "Mailing State": unicode(state),
+                  "Shares": u"{:.3f}".format(rand.randint(1, 500000) / 8.0),
+                  "Certified": rand.choice([u"Y", u"N"]), "LetterCode": u"", "Sequence": u"",
+                  "Escheatment State": unicode(escheat_name),
+                  "Escheatment Abbv": unicode(escheat_abbv)}
+        for n in xrange(8):
+            record["NameAddress{}".format(n + 1)] = lines[n] if n < len(lines) else u""
+        yield record
+
+
+def edgeCaseRecords(rows, seed=DEFAULT_SEED):
+    """ syntheticRecords with edge cases mixed in: NULL lines
+    in any spelling and position, FO states with a ZIP or a US
+    city, 9-digit ZIPs, apartment tails and near misses, raw
+    non-ASCII bytes, values cut at the field width and records
+    repeated a few lines after their first copy. Raw bytes make
+    a value a byte string, the other values are unicode. """
+
+    rand = random.Random(seed + 1)
+    widths = dict(parse.TXT_LAYOUT_VERSIONS[-1][1])
+    addr_fields = ["NameAddress{}".format(n) for n in xrange(1, 9)]
+    recent = collections.deque(maxlen=REPEAT_WINDOW)
+
+    for record in syntheticRecords(rows, seed):
+        if recent and rand.random() < EDGE_CASE_RATE / 10:
+            yield dict(rand.choice(recent))
+            continue
+        lines = [line for line in [record[field] for field in addr_fields] if line]
+
+        if rand.random() < EDGE_CASE_RATE:
+            lines.append(rand.choice(APT_TAILS))
+        if rand.random() < EDGE_CASE_RATE:
+            # Keep the name on the first line, foreign records
+            # are classified by their last line that is not NULL
+            for _ in xrange(rand.randint(1, 3)):
+                lines.insert(rand.randint(1, len(lines)), rand.choice(NULL_SPELLINGS))
+        if rand.random() < EDGE_CASE_RATE / 3:
+            lines = lines[:1] + [rand.choice(NULL_SPELLINGS) for _ in xrange(7)]
+        lines = (lines + [u""] * 8)[:8]
+        for field, line in zip(addr_fields, lines):
+            record[field] = line
+
+        if rand.random() < EDGE_CASE_RATE:
+            record["Zip"] = rand.choice(NINE_DIGIT_ZIPS).format(rand.randint(0, 99999),
+                                                                rand.randint(0, 9999))
+        if rand.random() < EDGE_CASE_RATE / 3:
+            if record["Mailing State"] == u"FO":
+                record["Mailing City"] = unicode(rand.choice(US_CITIES)[0])
+            else:
+                record["Mailing State"] = u"FO"
+        if rand.random() < EDGE_CASE_RATE / 3:
+            field = rand.choice(["Mailing City", "NameAddress1", "NameAddress2"])
+            record[field] = (record[field] + u" X" * widths[field])[:widths[field] + 5]
+        if rand.random() < EDGE_CASE_RATE / 3:
+            record["LT"] = rand.choice([u"", u"000000001"])
+
+        if rand.random() < EDGE_CASE_RATE:
+            field = rand.choice(addr_fields[:2] + ["Mailing City", "Company Name"])
+            value = record[field].encode("utf-8")[:widths[field] - 1]
+            if not value.translate(None, parse.ASCII_BYTES):
+                pos = rand.randint(0, len(value))
+                record[field] = value[:pos] + rand.choice(RAW_BYTES) + value[pos:]
+        recent.append(record)
+        yield record
+
+
+def pickWeighted(rand, choices, weights):
+    """ One of choices, drawn with the given weights. """
+    point = rand.random() * sum(weights)
+    for choice, weight in zip(choices, weights):
+        point -= weight
+        if point < 0:
+            return choice
+    return choices[-1]
+
+
+def writeTXT(txt_file, rows, seed=DEFAULT_SEED, version=None, edge_cases=False):
+    """ Write a fixed width file in a TXT layout version, the
+    current one by default. Fields are padded by character and
+    UTF-8 encoded, so lines with noise are longer in bytes.
+    With edge_cases the records come from edgeCaseRecords. """
+
+    versions = dict(parse.TXT_LAYOUT_VERSIONS)
+    fields = versions[version or parse.TXT_LAYOUT.version]
+    records = (edgeCaseRecords if edge_cases else syntheticRecords)(rows, seed)
+
+    with open(txt_file, 'wb') as o:
+        for record in records:
+            line = "".join(encodeField(record[field[0]], field[1]) for field in fields)
+            o.write(line + "\r\n")
+
+
+def encodeField(value, width):
+    """ value padded or cut to width characters, as bytes. A
+    byte string holds one character per byte. """
+    value = value[:width].ljust(width)
+    return value.encode("utf-8") if isinstance(value, unicode) else value
+
+
+def writeXLSX(excel_file, rows, seed=DEFAULT_SEED):
+    """ Write a workbook with the Excel headers. Blank cells are
+    empty, Company and Eligible Shares are numbers. """
+
+    if rows > parse.XLS_MAX_ROWS:
+        raise ValueError("An Excel sheet holds at most {} rows".format(parse.XLS_MAX_ROWS))
+
+    import openpyxl
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(EXCEL_HEADERS)
+    for record in syntheticRecords(rows, seed):
+        row = [record["LT"], record["Company Name"], int(record["Company Number"]),
+               record["Account Number"]]
+        row += [record["NameAddress{}".format(n)] for n in xrange(1, 8)]
+        row += [record["Mailing City"], record["Mailing State"], record["Zip"],
+                float(record["Shares"]), record["Escheatment Abbv"]]
+        ws.append([value if value != u"" else None for value in row])
+    wb.save(excel_file)
+
+
+def main(argv=None):
+    argv = argv or sys.argv[1:]
+    if len(argv) in [3, 4] and argv[0] in ["txt", "xlsx"]:
+        seed = int(argv[3]) if len(argv) == 4 else DEFAULT_SEED
+        writer = writeTXT if argv[0] == "txt" else writeXLSX
+        writer(argv[2], int(argv[1]), seed)
+        return 0
+    if len(argv) == 5 and argv[0] == "txt":
+        writeTXT(argv[2], int(argv[1]), int(argv[3]), argv[4])
+        return 0
+    if len(argv) in [3, 4] and argv[0] == "edge":
+        seed = int(argv[3]) if len(argv) == 4 else DEFAULT_SEED
+        writeTXT(argv[2], int(argv[1]), seed, edge_cases=True)
+        return 0
+    print __doc__
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())